@@ -1,10 +1,13 @@
+import datetime
 import json
 import logging
+import sys
 import click
-import xauldron.finstruments
 import signaldb
 import time
-import cProfile
+
+# Command specific modules (xauldron.finstruments, signaldb.formats, signaldb.dump, signaldb.local, signaldb.service,
+# signaldb.stats) are imported in the commands to keep the start-up time of short invocations low
 
 root_logger = logging.getLogger('')
 root_logger.setLevel(logging.INFO)
@@ -34,15 +37,21 @@ pass_config = click.make_pass_decorator(Config)
 @click.option('--user', default='', envvar='mongodb_user', help='Specify mongodb user explicitly')
 @click.option('--pwd', default='', envvar='mongodb_pwd', help='Specify mongodb credentials explicitly explicitly')
 @click.option('--col', default='', envvar='signaldb_collection', help='Specify the database to connect to')
+@click.option('--partition-by', default=None, envvar='signaldb_partition_by', type=click.Choice(['year']),
+              help='Partition observations by time (only for a new db)')
 @click.option('--debug/--no-debug', default=False, help='Show debug messages')
-def cli(ctx, host, port, user, pwd, col, debug):
+def cli(ctx, host, port, user, pwd, col, partition_by, debug):
     """signaldb   ..---...~~.. """
     if debug:
         root_logger.setLevel(logging.DEBUG)
     conn = signaldb.get_mongodb_conn(host, port, user, pwd, col)
     if conn is None:
         raise SystemExit(1)
-    sdb = signaldb.SignalDb(conn)
+    try:
+        sdb = signaldb.SignalDb(conn, partition_by)
+    except ValueError as e:
+        root_logger.error(str(e))
+        raise SystemExit(1)
     ctx.obj = Config(sdb)
 
 
@@ -51,8 +60,10 @@ def cli(ctx, host, port, user, pwd, col, debug):
 @click.option('--props_merge_mode', default='append', help="Supported modes are 'append' (default) and 'replace'")
 @click.option('--series_merge_mode', default='append', help="Supported modes are 'append' (default) and 'replace'")
 @click.option('--consolidate-input/--no-consolidate-input', default=True, help='Consolidate instruments.')
+@click.option('--processes', default=1, help='Number of processes used to check the input (default 1)')
 @pass_config
-def upsert(config, input_files, props_merge_mode, series_merge_mode, consolidate_input):
+def upsert(config, input_files, props_merge_mode, series_merge_mode, consolidate_input, processes):
+    import xauldron.finstruments
     root_logger.info('Checkpoint: %s' % xauldron.rfc3339.datetime_to_str(signaldb.get_utc_now()))
     time_stamp = time.perf_counter()
     try:
@@ -61,7 +72,7 @@ def upsert(config, input_files, props_merge_mode, series_merge_mode, consolidate
         logging.getLogger(__name__).error('File not found.')
         return
     config.sdb.upsert(instruments, props_merge_mode=props_merge_mode, series_merge_mode=series_merge_mode,
-                      consolidate_flag=consolidate_input)
+                      consolidate_flag=consolidate_input, processes=processes)
     root_logger.debug('Total execution time : %f' % (time.perf_counter() - time_stamp))
 
 
@@ -72,15 +83,52 @@ def rollback(config, time_stamp):
     config.sdb.rollback(time_stamp)
 
 
+def to_selection(keys):
+    """Map an empty click multiple option to None (no selection)"""
+    if len(keys) == 0:
+        return None
+    return list(keys)
+
+
+def write_output(instruments, output_format, output):
+    """Write instruments to the output file (stdout by default) in the requested format"""
+    import signaldb.formats
+    mode = 'wb' if signaldb.formats.is_binary_format(output_format) else 'w'
+    with click.open_file(output, mode) as fp:
+        signaldb.formats.write_instruments(instruments, fp, output_format)
+
+
 @cli.command('get')
 @click.argument('source', nargs=1)
 @click.argument('ticker', nargs=1)
+@click.option('--series-key', '-s', multiple=True, help='Return only the given series (can be repeated)')
+@click.option('--props-field', '-p', multiple=True, help='Return only the given properties (can be repeated)')
+@click.option('--format', 'output_format', default='json', type=click.Choice(signaldb.FORMATS),
+              help='Output format (default json)')
+@click.option('--output', '-o', default='-', help='Output file (default stdout)')
 @pass_config
-def get(config, source, ticker):
-    instrument = config.sdb.get(source, ticker)
+def get(config, source, ticker, series_key, props_field, output_format, output):
+    instrument = config.sdb.get(source, ticker, series_keys=to_selection(series_key),
+                                props_fields=to_selection(props_field))
     if instrument is None:
         return
-    click.echo(json.dumps(instrument, indent=4, sort_keys=True, cls=signaldb.JSONEncoderExtension))
+    if output_format == 'json':
+        write_output(instrument, output_format, output)
+    else:
+        write_output([instrument, ], output_format, output)
+
+
+@cli.command('latest')
+@click.argument('source', nargs=1)
+@click.argument('ticker', nargs=1)
+@click.option('--series-key', '-s', multiple=True, help='Return only the given series (can be repeated)')
+@click.option('-n', default=1, help='Number of observations to return (default 1)')
+@pass_config
+def latest(config, source, ticker, series_key, n):
+    instruments = config.sdb.get_latest([(source, ticker), ], series_keys=to_selection(series_key), n=n)
+    if instruments is None or instruments[0] is None:
+        return
+    click.echo(json.dumps(instruments[0], indent=4, sort_keys=True, cls=signaldb.JSONEncoderExtension))
 
 
 @cli.command('list')
@@ -101,26 +149,161 @@ def list_tickers(config, source):
 
 
 @cli.command('info')
+@click.option('--detail/--no-detail', default=False, help='Show collection, source, revision and series statistics')
+@click.option('--sample', default=0, help='Estimate series statistics from a sample of observations')
+@click.option('--top', default=10, help='Number of the heaviest series and most revised docs to show')
 @pass_config
-def info(config):
+def info(config, detail, sample, top):
+    import signaldb.stats
     doc_count = config.sdb.count_items()
     click.echo('Object count: %d refs, %d paths, %d sheets.' % doc_count)
     click.echo('Checkpoint: %s' % str(signaldb.get_utc_now()))
+    if not detail:
+        return
+    click.echo('Collections:')
+    for col in signaldb.stats.collection_stats(config.sdb):
+        click.echo('  %s: %d docs, %d bytes data, %d bytes storage, %d bytes indexes' %
+                   (col['name'], col['count'], col['size'], col['storage_size'], col['index_size']))
+        for name, index in sorted(col['indexes'].items()):
+            ops = 'unknown' if index['ops'] is None else '%d' % index['ops']
+            click.echo('    %s: %d bytes, %s ops' % (name, index['size'], ops))
+    click.echo('Sources:')
+    for source, counts in sorted(signaldb.stats.source_stats(config.sdb).items()):
+        click.echo('  %s: %d tickers, %d instruments' % (source, counts['tickers'], counts['instruments']))
+    click.echo('Most revised paths:')
+    for item in signaldb.stats.revision_stats(config.sdb, top):
+        click.echo('  %s: %d revisions, last %s' % (item['_id'], item['revisions'], str(item['last_revision'])))
+    click.echo('Heaviest series%s:' % (' (estimated)' if sample > 0 else ''))
+    for item in signaldb.stats.series_stats(config.sdb, top, sample if sample > 0 else None):
+        tickers = ' '.join('%s:%s' % tuple(ticker) for ticker in item['tickers'])
+        click.echo('  %s %s (%s): %d observations, %d revisions' %
+                   (item['series_key'], item['name'], tickers, item['observations'], item['revisions']))
+
+
+@cli.command('export')
+@click.argument('path', nargs=1)
+@click.option('--chunk-size', default=1000000, help='Maximal number of documents per snapshot file')
+@pass_config
+def export_snapshot(config, path, chunk_size):
+    """Export the whole db into a snapshot directory"""
+    import signaldb.dump
+    if not signaldb.dump.export_db(config.sdb, path, chunk_size):
+        raise SystemExit(1)
+
+
+@cli.command('import')
+@click.argument('path', nargs=1)
+@click.option('--chunk-size', default=100000, help='Number of documents per bulk insert')
+@click.option('--purge/--no-purge', default=False, help='Remove all data from the db before the import')
+@pass_config
+def import_snapshot(config, path, chunk_size, purge):
+    """Load a snapshot directory into an empty db"""
+    import signaldb.dump
+    if purge:
+        config.sdb.purge_db()
+    if not signaldb.dump.import_db(config.sdb, path, chunk_size):
+        raise SystemExit(1)
+
+
+@cli.command('materialize')
+@click.argument('path', nargs=1)
+@click.option('--source', default='', help='Include only tickers from the given source')
+@click.option('--now', default='', help='Snapshot time (default: current time)')
+@click.option('--series-key', '-s', multiple=True, help='Include only the given series (can be repeated)')
+@pass_config
+def materialize(config, path, source, now, series_key):
+    """Write a memory-mapped local snapshot of the db"""
+    import signaldb.local
+    now = signaldb.str_to_datetime(now) if len(now) > 0 else None
+    ticker_list = config.sdb.list_tickers(source, now)
+    if ticker_list is None:
+        raise SystemExit(1)
+    if signaldb.local.materialize(config.sdb, path, ticker_list, now, to_selection(series_key)) is None:
+        raise SystemExit(1)
+
+
+@cli.group('partitions')
+def partitions():
+    """Manage time partitions of the observations"""
+
+
+@partitions.command('list')
+@pass_config
+def list_partitions(config):
+    for col in config.sdb.sheets_cols():
+        click.echo(col)
+
+
+@partitions.command('drop')
+@click.argument('before_year', nargs=1, type=int)
+@pass_config
+def drop_partitions(config, before_year):
+    """Drop all partitions of years before BEFORE_YEAR"""
+    before_col = config.sdb.sheets_col_for(datetime.datetime(before_year, 1, 1))
+    for col in [col for col in config.sdb.sheets_cols() if col < before_col]:
+        config.sdb.drop_partition(col)
+        root_logger.info('Dropped %s.' % col)
+
+
+@partitions.command('archive')
+@click.argument('path', nargs=1)
+@click.argument('before_year', nargs=1, type=int)
+@click.option('--chunk-size', default=1000000, help='Maximal number of documents per archive file')
+@pass_config
+def archive_partitions(config, path, before_year, chunk_size):
+    """Move all partitions of years before BEFORE_YEAR into files in PATH"""
+    import signaldb.dump
+    if not signaldb.dump.archive_partitions(config.sdb, path, before_year, chunk_size):
+        raise SystemExit(1)
+
+
+@cli.command('serve')
+@click.option('--host', default='127.0.0.1', help='Address to listen on (default 127.0.0.1)')
+@click.option('--port', default=8080, help='Port to listen on (default 8080)')
+@click.option('--cache-mb', default=64, help='Total size of the cached responses in MiB (default 64)')
+@click.option('--max-cached-kb', default=1024, help='Size of the largest cached response in KiB (default 1024)')
+@click.option('--revision-poll', default=1.0, help='Seconds between checks of the db revision (default 1)')
+@pass_config
+def serve(config, host, port, cache_mb, max_cached_kb, revision_poll):
+    """Serve read-only queries over HTTP"""
+    import signaldb.service
+    signaldb.service.serve(config.sdb, host, port, cache_mb * 2 ** 20, max_cached_kb * 2 ** 10, revision_poll)
 
 
 @cli.command('find')
 @click.argument('filter_doc', nargs=1)
+@click.option('--series-key', '-s', multiple=True, help='Return only the given series (can be repeated)')
+@click.option('--props-field', '-p', multiple=True, help='Return only the given properties (can be repeated)')
+@click.option('--format', 'output_format', default='json', type=click.Choice(signaldb.FORMATS),
+              help='Output format (default json)')
+@click.option('--output', '-o', default='-', help='Output file (default stdout)')
 @pass_config
-def find(config, filter_doc):
+def find(config, filter_doc, series_key, props_field, output_format, output):
     try:
         filter_doc = json.loads(filter_doc)
     except json.decoder.JSONDecodeError:
         logging.getLogger().error('Error parsing search query')
         return
-    instruments = config.sdb.find_instruments(filter_doc)
-    click.echo(json.dumps(instruments, indent=4, sort_keys=True, cls=signaldb.JSONEncoderExtension))
+    instruments = config.sdb.find_instruments(filter_doc, series_keys=to_selection(series_key),
+                                              props_fields=to_selection(props_field))
+    if instruments is None:
+        return
+    write_output(instruments, output_format, output)
+
+
+@cli.command('batch')
+@pass_config
+def batch(config):
+    """Answer queries given as json lines on stdin over one connection.
+
+    Each line is a json object {"query": <name>, "params": {...}, "id": <optional>} with one of the queries get,
+    get_many, list_tickers, find_instruments or get_latest. Each query is answered with one json line on stdout."""
+    import signaldb.service
+    if signaldb.service.run_batch(config.sdb, sys.stdin, sys.stdout) > 0:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
+    import cProfile
     cProfile.run('cli()')
     #cli()
@@ -0,0 +1,111 @@
+import collections
+import multiprocessing
+import re
+import numpy
+import xauldron
+
+RFC3339_UTC_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{1,6})?Z')
+
+
+def consolidate(instruments: list, props_merge_mode='append', processes=None, logger=None):
+    """Parse, check and consolidate a list of instruments.
+
+    Gives the same result as running xauldron.rfc3339.recursive_str_to_datetime, xauldron.finstruments.check and
+    xauldron.finstruments.consolidate on the whole list, but parses series time stamps in vectorized form and only
+    consolidates instruments sharing tickers with each other. The check step runs in a pool of the given number of
+    processes if processes > 1. Return None if consolidation fails."""
+    for instrument in instruments:
+        parse_datetimes(instrument)
+    checked_instruments = []
+    for i, check_result in enumerate(check_instruments(instruments, processes)):
+        if check_result != 0:
+            if logger is not None:
+                logger.error('Supplied instrument has wrong type (index no %d; failed test %d).' %
+                             (i + 1, check_result))
+            continue
+        checked_instruments.append(instruments[i])
+    consolidated_instruments = []
+    for group in group_by_tickers(checked_instruments):
+        consolidated_group = xauldron.finstruments.consolidate(group, props_merge_mode)
+        if consolidated_group is None:
+            return None
+        consolidated_instruments.extend(consolidated_group)
+    return consolidated_instruments
+
+
+def check_instruments(instruments: list, processes=None):
+    """Return the xauldron.finstruments.check result for each instrument"""
+    if processes is None or processes <= 1 or len(instruments) < 2:
+        return [xauldron.finstruments.check(instrument) for instrument in instruments]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(xauldron.finstruments.check, instruments,
+                        chunksize=max(1, len(instruments) // (4 * processes)))
+
+
+def group_by_tickers(instruments: list):
+    """Split instruments into groups connected by shared tickers (union-find over a ticker -> instrument index)"""
+    parent = list(range(len(instruments)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owners = {}
+    for i, instrument in enumerate(instruments):
+        for ticker in instrument['tickers']:
+            j = owners.setdefault((ticker[0], ticker[1]), i)
+            if j != i:
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+    groups = collections.OrderedDict()
+    for i, instrument in enumerate(instruments):
+        groups.setdefault(find(i), []).append(instrument)
+    return list(groups.values())
+
+
+def parse_datetimes(instrument):
+    """Convert time stamp strings in an instrument into datetime objects (in place)"""
+    if type(instrument) is not dict or type(instrument.get('series', None)) is not dict:
+        xauldron.rfc3339.recursive_str_to_datetime([instrument, ])
+        return
+    other_fields = {key: value for key, value in instrument.items() if key != 'series'}
+    xauldron.rfc3339.recursive_str_to_datetime(other_fields)
+    instrument.update(other_fields)
+    for series in instrument['series'].values():
+        if type(series) is not list or not all(type(sample) is list and len(sample) == 2 for sample in series):
+            xauldron.rfc3339.recursive_str_to_datetime(series)
+            continue
+        times = parse_times([sample[0] for sample in series])
+        values = [sample[1] for sample in series]
+        if not all(type(v) in (int, float, bool) or v is None for v in values):
+            xauldron.rfc3339.recursive_str_to_datetime(values)
+        for sample, t, v in zip(series, times, values):
+            sample[0] = t
+            sample[1] = v
+
+
+def parse_times(times: list):
+    """Vectorized conversion of RFC 3339 UTC time stamp strings into datetime objects.
+
+    Lists containing other values or time stamp formats are converted element-wise by xauldron."""
+    if len(times) == 0 or not all(type(t) is str and RFC3339_UTC_PATTERN.fullmatch(t) for t in times):
+        xauldron.rfc3339.recursive_str_to_datetime(times)
+        return times
+    try:
+        parsed_times = numpy.array([t[:-1] for t in times], dtype='datetime64[us]').tolist()
+    except ValueError:
+        # Matching the pattern but not a valid date, e.g. 2019-02-30 or a leap second
+        xauldron.rfc3339.recursive_str_to_datetime(times)
+        return times
+    # Calibrate against the reference parser (time zone info and precision of fractional seconds)
+    tz_info = xauldron.rfc3339.str_to_datetime(times[0]).tzinfo
+    if tz_info is not None:
+        parsed_times = [t.replace(tzinfo=tz_info) for t in parsed_times]
+    for i in {0, max(range(len(times)), key=lambda j: len(times[j]))}:
+        if parsed_times[i] != xauldron.rfc3339.str_to_datetime(times[i]):
+            xauldron.rfc3339.recursive_str_to_datetime(times)
+            return times
+    return parsed_times
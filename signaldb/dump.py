@@ -0,0 +1,205 @@
+import datetime
+import json
+import logging
+import os
+import time
+import numpy
+import bson
+from bson.codec_options import CodecOptions
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+import signaldb
+from .formats import datetimes_to_epoch_ms, epoch_ms_to_datetimes, values_to_array, array_to_values, NATIVE_TYPES
+
+SNAPSHOT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+RAW_BSON_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+logger = logging.getLogger(__name__)
+
+
+def export_db(sdb, path: str, chunk_size=1000000):
+    """Export refs, paths and sheets into a snapshot directory.
+
+    Refs and paths are copied as raw BSON. Observations are written column-wise (k, t, r, v) into npz partitions of
+    at most chunk_size rows, with t and r stored as epoch milliseconds and k as 12-byte rows. Revisions are
+    preserved."""
+    if os.path.exists(path) and len(os.listdir(path)) > 0:
+        logger.error('Snapshot directory %s is not empty.' % path)
+        return False
+    os.makedirs(path, exist_ok=True)
+    time_stamp = time.perf_counter()
+    manifest = {'version': SNAPSHOT_VERSION, 'created': signaldb.get_utc_now(), 'collections': {},
+                'sheets': sdb.sheets_cols()}
+    for col in [sdb.refs_col, sdb.paths_col]:
+        manifest['collections'][col] = export_documents(sdb.db[col], os.path.join(path, col), chunk_size)
+    for col in manifest['sheets']:
+        manifest['collections'][col] = export_observations(sdb.db[col], os.path.join(path, col), chunk_size)
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as fp:
+        json.dump(manifest, fp, indent=4, sort_keys=True, cls=signaldb.JSONEncoderExtension)
+    log_throughput('Exported', manifest, time.perf_counter() - time_stamp)
+    return True
+
+
+def import_db(sdb, path: str, chunk_size=100000):
+    """Load a snapshot directory written by export_db into an empty db.
+
+    The indexes are dropped during the load and rebuilt afterwards. Observations are routed into the sheets
+    collections of the target db, so a snapshot can be loaded into a db with a different partitioning scheme."""
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        logger.error('No snapshot found in %s.' % path)
+        return False
+    with open(manifest_path) as fp:
+        manifest = json.load(fp)
+    if manifest.get('version', None) != SNAPSHOT_VERSION:
+        logger.error('Unsupported snapshot version.')
+        return False
+    if sum(sdb.count_items()) > 0:
+        logger.error('The target db is not empty.')
+        return False
+    time_stamp = time.perf_counter()
+    sdb.drop_indexes()
+    try:
+        for col in [sdb.refs_col, sdb.paths_col]:
+            import_documents(sdb.db[col], os.path.join(path, col), manifest['collections'][col]['parts'],
+                             chunk_size)
+        for col in manifest['sheets']:
+            import_observations(sdb, os.path.join(path, col), manifest['collections'][col]['parts'], chunk_size)
+    finally:
+        logger.info('Building indexes.')
+        sdb.create_indexes()
+        sdb.touch_revision()
+    log_throughput('Imported', manifest, time.perf_counter() - time_stamp)
+    return True
+
+
+def export_documents(col, path: str, chunk_size: int):
+    """Copy all documents of a collection into chunked raw BSON files"""
+    os.makedirs(path)
+    doc_count = 0
+    parts = []
+    fp = None
+    try:
+        for doc in col.with_options(codec_options=RAW_BSON_OPTIONS).find():
+            if doc_count % chunk_size == 0:
+                if fp is not None:
+                    fp.close()
+                parts.append(part_file_name(len(parts), 'bson'))
+                fp = open(os.path.join(path, parts[-1]), 'wb')
+            fp.write(doc.raw)
+            doc_count += 1
+    finally:
+        if fp is not None:
+            fp.close()
+    return {'docs': doc_count, 'parts': parts}
+
+
+def import_documents(col, path: str, parts: list, chunk_size: int):
+    for part in parts:
+        with open(os.path.join(path, part), 'rb') as fp:
+            docs = []
+            for doc in bson.decode_file_iter(fp, codec_options=RAW_BSON_OPTIONS):
+                docs.append(doc)
+                if len(docs) == chunk_size:
+                    col.insert_many(docs, ordered=False)
+                    docs = []
+            if len(docs) > 0:
+                col.insert_many(docs, ordered=False)
+
+
+def export_observations(col, path: str, chunk_size: int):
+    """Write all observations of a sheets collection into column-wise npz partitions"""
+    os.makedirs(path)
+    doc_count = 0
+    parts = []
+    chunk = []
+    cursor = col.find({}, {'_id': 0, 'k': 1, 't': 1, 'r': 1, 'v': 1}).batch_size(10000)
+    for doc in cursor:
+        chunk.append(doc)
+        if len(chunk) == chunk_size:
+            parts.extend(write_observations(chunk, path, len(parts)))
+            doc_count += len(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        parts.extend(write_observations(chunk, path, len(parts)))
+        doc_count += len(chunk)
+    return {'docs': doc_count, 'parts': parts}
+
+
+def write_observations(docs: list, path: str, part_no: int):
+    """Write observations into npz partitions, one for each value type, and return the file names.
+
+    Splitting by type keeps the values of each partition in a native array instead of letting numpy coerce mixed
+    values (e.g. numbers and strings) into one type. All other values (datetimes, ObjectIds, None, documents) share
+    one partition stored as BSON."""
+    groups = {}
+    for doc in docs:
+        groups.setdefault(type(doc['v']) if type(doc['v']) in NATIVE_TYPES else None, []).append(doc)
+    file_names = []
+    for group_docs in groups.values():
+        file_names.append(write_observations_part(group_docs, path, part_no + len(file_names)))
+    return file_names
+
+
+def write_observations_part(docs: list, path: str, part_no: int):
+    file_name = part_file_name(part_no, 'npz')
+    keys = numpy.frombuffer(b''.join(doc['k'].binary for doc in docs), dtype=numpy.uint8).reshape(-1, 12)
+    values, encoding = values_to_array([doc['v'] for doc in docs])
+    numpy.savez(os.path.join(path, file_name),
+                k=keys,
+                t=datetimes_to_epoch_ms([doc['t'] for doc in docs]),
+                r=datetimes_to_epoch_ms([doc['r'] for doc in docs]),
+                v=values,
+                encoding=numpy.array(encoding))
+    return file_name
+
+
+def import_observations(sdb, path: str, parts: list, chunk_size: int):
+    for part in parts:
+        with numpy.load(os.path.join(path, part), allow_pickle=False) as arrays:
+            keys = arrays['k'].tobytes()
+            keys = [ObjectId(keys[i:i + 12]) for i in range(0, len(keys), 12)]
+            times = epoch_ms_to_datetimes(arrays['t'])
+            revisions = epoch_ms_to_datetimes(arrays['r'])
+            values = array_to_values(arrays['v'], str(arrays['encoding']))
+        for i in range(0, len(keys), chunk_size):
+            partitioned_docs = {}
+            for k, t, r, v in zip(keys[i:i + chunk_size], times[i:i + chunk_size], revisions[i:i + chunk_size],
+                                  values[i:i + chunk_size]):
+                partitioned_docs.setdefault(sdb.sheets_col_for(t), []).append({'k': k, 't': t, 'r': r, 'v': v})
+            for col, docs in partitioned_docs.items():
+                sdb.db[col].insert_many(docs, ordered=False)
+
+
+def archive_partitions(sdb, path: str, before_year: int, chunk_size=1000000):
+    """Move all sheets partitions of years before before_year into column-wise npz files and drop them"""
+    if sdb.partition_by is None:
+        logger.error('The db is not partitioned.')
+        return False
+    cols = [col for col in sdb.sheets_cols() if col < sdb.sheets_col_for(datetime.datetime(before_year, 1, 1))]
+    os.makedirs(path, exist_ok=True)
+    for col in cols:
+        if os.path.exists(os.path.join(path, col)):
+            logger.error('Archive of %s exists already in %s.' % (col, path))
+            return False
+    for col in cols:
+        manifest = {'version': SNAPSHOT_VERSION, 'created': signaldb.get_utc_now(),
+                    'collections': {col: export_observations(sdb.db[col], os.path.join(path, col), chunk_size)}}
+        with open(os.path.join(path, col, MANIFEST_FILE), 'w') as fp:
+            json.dump(manifest, fp, indent=4, sort_keys=True, cls=signaldb.JSONEncoderExtension)
+        sdb.drop_partition(col)
+        logger.info('Archived %d observations of %s.' % (manifest['collections'][col]['docs'], col))
+    return True
+
+
+def part_file_name(part_no: int, extension: str):
+    return 'part-%05d.%s' % (part_no, extension)
+
+
+def log_throughput(action: str, manifest: dict, seconds: float):
+    counts = {col: item['docs'] for col, item in manifest['collections'].items()}
+    observations = sum(item['docs'] for col, item in manifest['collections'].items() if col.startswith('sheets'))
+    logger.info('%s %s in %fs (%.0f observations/s).' %
+                (action, ', '.join('%d %s' % (counts[col], col) for col in sorted(counts)), seconds,
+                 observations / max(seconds, 1e-9)))
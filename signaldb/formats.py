@@ -0,0 +1,163 @@
+import json
+import bson
+import bson.errors
+import numpy
+from .utils import JSONEncoderExtension, FORMATS
+
+
+def datetimes_to_epoch_ms(times) -> numpy.ndarray:
+    """Convert a list of naive UTC datetimes into an array of milliseconds since the epoch"""
+    return numpy.array(times, dtype='datetime64[ms]').astype(numpy.int64)
+
+
+def epoch_ms_to_datetimes(epoch_ms) -> list:
+    """Convert an array of milliseconds since the epoch into a list of naive UTC datetimes"""
+    return numpy.asarray(epoch_ms, dtype=numpy.int64).astype('datetime64[ms]').tolist()
+
+
+NATIVE_TYPES = {float: numpy.float64, int: numpy.int64, bool: numpy.bool_, str: str}
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def values_to_array(values: list):
+    """Convert a list of observation values into a typed array and return it with the used encoding.
+
+    Values are stored natively only if all of them have the same type (float, int, bool or str); mixed lists
+    would be coerced by numpy (e.g. [1.5, 'NA'] into strings). Other values are stored as concatenated BSON
+    documents {'v': value} in a uint8 array, which keeps datetimes, ObjectIds and nested values exact. Values that
+    BSON cannot hold (ints beyond int64) are stored as json strings."""
+    value_types = set(type(v) for v in values)
+    if len(value_types) == 0:
+        return numpy.zeros(0, dtype=numpy.float64), 'native'
+    value_type = value_types.pop() if len(value_types) == 1 else None
+    if value_type is int and not all(INT64_MIN <= v <= INT64_MAX for v in values):
+        value_type = None
+    if value_type in NATIVE_TYPES:
+        return numpy.array(values, dtype=NATIVE_TYPES[value_type]), 'native'
+    try:
+        return numpy.frombuffer(b''.join(bson.BSON.encode({'v': v}) for v in values), dtype=numpy.uint8), 'bson'
+    except (bson.errors.InvalidDocument, OverflowError):
+        return numpy.array([json.dumps(v, cls=JSONEncoderExtension) for v in values], dtype=str), 'json'
+
+
+def array_to_values(array, encoding='native') -> list:
+    """Inverse of values_to_array"""
+    if encoding == 'bson':
+        return [doc['v'] for doc in bson.decode_all(array.tobytes())]
+    values = array.tolist()
+    if encoding == 'json':
+        values = [json.loads(v) for v in values]
+    return values
+
+
+def series_to_columns(series: list):
+    """Split a series [[t, v], ...] into an array of epoch milliseconds and an array of values"""
+    times = datetimes_to_epoch_ms([sample[0] for sample in series])
+    values, encoding = values_to_array([sample[1] for sample in series])
+    return times, values, encoding
+
+
+def columns_to_series(times, values, encoding='native') -> list:
+    """Inverse of series_to_columns"""
+    return [list(sample) for sample in zip(epoch_ms_to_datetimes(times), array_to_values(values, encoding))]
+
+
+def write_json(instruments: list, fp):
+    """Write instruments (or a single instrument) as an indented json document"""
+    fp.write(json.dumps(instruments, indent=4, sort_keys=True, cls=JSONEncoderExtension))
+    fp.write('\n')
+
+
+def write_jsonl(instruments: list, fp):
+    """Write instruments as compact json, one instrument per line.
+
+    Series are written column-wise as {"t": [...], "v": [...]} with time stamps given in milliseconds since the
+    epoch."""
+    encoder = JSONEncoderExtension(separators=(',', ':'))
+    for instrument in instruments:
+        if instrument is not None:
+            series = {}
+            for key, observations in instrument['series'].items():
+                times, values, encoding = series_to_columns(observations)
+                if encoding == 'native':
+                    values = values.tolist()
+                else:
+                    values = [sample[1] for sample in observations]
+                series[key] = {'t': times.tolist(), 'v': values}
+            instrument = dict(instrument, series=series)
+        fp.write(encoder.encode(instrument))
+        fp.write('\n')
+
+
+def read_jsonl(fp) -> list:
+    """Read instruments written by write_jsonl"""
+    instruments = []
+    for line in fp:
+        if len(line.strip()) == 0:
+            continue
+        instrument = json.loads(line)
+        if instrument is not None:
+            instrument['series'] = {key: [list(sample) for sample in zip(epoch_ms_to_datetimes(columns['t']),
+                                                                         columns['v'])]
+                                    for key, columns in instrument['series'].items()}
+        instruments.append(instrument)
+    return instruments
+
+
+def write_npz(instruments: list, fp):
+    """Write instruments into a NumPy npz archive.
+
+    Each series is stored as two typed arrays: 'i.j.t' (epoch milliseconds, int64) and 'i.j.v', where i is the
+    instrument number and j is the series number. Tickers, properties and series keys are kept in the json
+    array 'meta'."""
+    meta = []
+    arrays = {}
+    for i, instrument in enumerate(instruments):
+        if instrument is None:
+            meta.append(None)
+            continue
+        series_meta = []
+        for j, (key, observations) in enumerate(instrument['series'].items()):
+            times, values, encoding = series_to_columns(observations)
+            arrays['%d.%d.t' % (i, j)] = times
+            arrays['%d.%d.v' % (i, j)] = values
+            series_meta.append([key, encoding])
+        meta.append({'tickers': instrument['tickers'], 'properties': instrument.get('properties', {}),
+                     'series': series_meta})
+    arrays['meta'] = numpy.array(json.dumps(meta, cls=JSONEncoderExtension))
+    numpy.savez(fp, **arrays)
+
+
+def read_npz(fp) -> list:
+    """Read instruments written by write_npz"""
+    instruments = []
+    with numpy.load(fp, allow_pickle=False) as arrays:
+        meta = json.loads(str(arrays['meta']))
+        for i, instrument_meta in enumerate(meta):
+            if instrument_meta is None:
+                instruments.append(None)
+                continue
+            series = {}
+            for j, (key, encoding) in enumerate(instrument_meta['series']):
+                series[key] = columns_to_series(arrays['%d.%d.t' % (i, j)], arrays['%d.%d.v' % (i, j)], encoding)
+            instruments.append(dict(tickers=instrument_meta['tickers'], properties=instrument_meta['properties'],
+                                    series=series))
+    return instruments
+
+
+def write_instruments(instruments: list, fp, output_format='json'):
+    """Write instruments to a file object in one of the supported formats.
+
+    The formats json and jsonl require a text file, npz requires a binary file."""
+    if output_format == 'json':
+        write_json(instruments, fp)
+    elif output_format == 'jsonl':
+        write_jsonl(instruments, fp)
+    elif output_format == 'npz':
+        write_npz(instruments, fp)
+    else:
+        raise ValueError('Unsupported output format %s' % output_format)
+
+
+def is_binary_format(output_format: str):
+    return output_format == 'npz'
@@ -0,0 +1,192 @@
+import copy
+import datetime
+import logging
+import os
+import bson
+import numpy
+from .formats import datetimes_to_epoch_ms, epoch_ms_to_datetimes
+from .signaldb import select_series_refs
+
+INDEX_FILE = 'index.bson'
+TIMES_FILE = 't.bin'
+VALUES_FILE = 'v.bin'
+# Value types of series kept in a snapshot: Python type -> array dtype. Each dtype has its own pair of files.
+DTYPES = {float: 'float64', int: 'int64', bool: 'bool'}
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+logger = logging.getLogger(__name__)
+
+
+def materialize(sdb, path: str, ticker_list=None, now=None, series_keys=None):
+    """Write a snapshot of instruments at the time now into a LocalSnapshot directory and open it.
+
+    By default all tickers valid at now are included. Series are kept only if all their values are floats, all are
+    ints (within int64) or all are bools; other series are skipped, so that the snapshot returns the values of the
+    db unchanged."""
+    now = sdb.set_now(now)
+    if now is None:
+        return None
+    if ticker_list is None:
+        ticker_list = sdb.list_tickers(now=now)
+    if ticker_list is None:
+        return None
+    if os.path.exists(path) and len(os.listdir(path)) > 0:
+        logger.error('Snapshot directory %s is not empty.' % path)
+        return None
+    os.makedirs(path, exist_ok=True)
+
+    # Group the tickers by instrument (tickers of an instrument share the series id)
+    requested = set((source, ticker) for source, ticker in ticker_list)
+    groups = {}
+    for ticker_record in sdb.db[sdb.refs_col].find({'valid_from': {'$lte': now}, 'valid_until': {'$gte': now}}):
+        if (ticker_record['source'], ticker_record['ticker']) in requested:
+            groups.setdefault(ticker_record['series'], []).append([ticker_record['source'], ticker_record['ticker']])
+
+    instruments = []
+    lengths = {dtype: 0 for dtype in DTYPES.values()}
+    files = {}
+    try:
+        for dtype in DTYPES.values():
+            files[dtype] = (open(os.path.join(path, data_file_name(TIMES_FILE, dtype)), 'wb'),
+                            open(os.path.join(path, data_file_name(VALUES_FILE, dtype)), 'wb'))
+        for tickers in groups.values():
+            instrument = sdb.get(tickers[0][0], tickers[0][1], now, series_keys=series_keys)
+            if instrument is None:
+                continue
+            series_index = {}
+            for key, observations in instrument['series'].items():
+                dtype = series_dtype([sample[1] for sample in observations])
+                if dtype is None:
+                    logger.warning('Skipping the series %s of (%s,%s) with values which are not all floats, ints '
+                                   'or bools.' % (key, tickers[0][0], tickers[0][1]))
+                    continue
+                times_fp, values_fp = files[dtype]
+                times_fp.write(datetimes_to_epoch_ms([sample[0] for sample in observations]).tobytes())
+                values_fp.write(numpy.array([sample[1] for sample in observations], dtype=dtype).tobytes())
+                series_index[key] = [lengths[dtype], len(observations), dtype]
+                lengths[dtype] += len(observations)
+            instruments.append({'tickers': sorted(tickers), 'properties': instrument['properties'],
+                                'series': series_index})
+    finally:
+        for times_fp, values_fp in files.values():
+            times_fp.close()
+            values_fp.close()
+    # The index is written last and marks the snapshot as complete
+    with open(os.path.join(path, INDEX_FILE), 'wb') as fp:
+        fp.write(bson.BSON.encode({'now': now, 'lengths': lengths, 'instruments': instruments}))
+    logger.debug('Materialized %d instruments with %d observations in %s.' % (len(instruments),
+                                                                               sum(lengths.values()), path))
+    return LocalSnapshot(path)
+
+
+def series_dtype(values: list):
+    """Return the array dtype holding all values exactly, or None"""
+    value_types = set(type(v) for v in values)
+    if len(value_types) != 1:
+        return None if len(value_types) > 1 else DTYPES[float]
+    value_type = value_types.pop()
+    if value_type is int and not all(INT64_MIN <= v <= INT64_MAX for v in values):
+        return None
+    return DTYPES.get(value_type, None)
+
+
+def data_file_name(file_name: str, dtype: str):
+    """Return the name of the times or values file of a dtype (float64 uses the plain names t.bin and v.bin)"""
+    if dtype == DTYPES[float]:
+        return file_name
+    base, extension = os.path.splitext(file_name)
+    return '%s_%s%s' % (base, dtype, extension)
+
+
+class LocalSnapshot:
+    """Read-only replica of a db snapshot stored in memory-mapped files.
+
+    The observations of all series are kept in flat arrays (epoch milliseconds and values, one pair of arrays for
+    each of the value types float64, int64 and bool) mapped read-only into memory, so that many processes share the
+    same pages. Supports the query interface of SignalDb for the snapshot time."""
+    def __init__(self, path: str):
+        index_path = os.path.join(path, INDEX_FILE)
+        if not os.path.isfile(index_path):
+            raise FileNotFoundError('No local snapshot found in %s' % path)
+        with open(index_path, 'rb') as fp:
+            index = bson.BSON(fp.read()).decode()
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.now = index['now']
+        self.instruments = index['instruments']
+        self.ticker_index = {}
+        for i, instrument in enumerate(self.instruments):
+            for source, ticker in instrument['tickers']:
+                self.ticker_index[(source, ticker)] = i
+        self.times = {}
+        self.values = {}
+        for dtype, length in index['lengths'].items():
+            if length > 0:
+                self.times[dtype] = numpy.memmap(os.path.join(path, data_file_name(TIMES_FILE, dtype)),
+                                                 dtype=numpy.int64, mode='r')
+                self.values[dtype] = numpy.memmap(os.path.join(path, data_file_name(VALUES_FILE, dtype)),
+                                                  dtype=dtype, mode='r')
+            else:
+                self.times[dtype] = numpy.zeros(0, dtype=numpy.int64)
+                self.values[dtype] = numpy.zeros(0, dtype=dtype)
+
+    def list_tickers(self, source='', now=None):
+        """Return a list of all available tickers matching a given source"""
+        if not self.__check_now(now):
+            return None
+        if type(source) is not str:
+            self.logger.error('Source must be a string')
+            return None
+        return [pair for pair in self.ticker_index.keys() if len(source) == 0 or pair[0] == source]
+
+    def get_many(self, ticker_list, now=None, series_from=datetime.datetime.min, series_to=datetime.datetime.max,
+                 series_keys=None, props_fields=None):
+        """Get instruments and return them in the standard form"""
+        if type(ticker_list) is list:
+            return [self.get(source, ticker, now, series_from, series_to, series_keys, props_fields)
+                    for source, ticker in ticker_list]
+        raise ValueError('Ticker_list argument is not a list')
+
+    def get(self, source: str, ticker: str, now=None,
+            series_from=datetime.datetime.min, series_to=datetime.datetime.max, series_keys=None, props_fields=None):
+        """Get a single instrument and return it in the standard form"""
+        if not self.__check_now(now):
+            return None
+        if (source, ticker) not in self.ticker_index:
+            self.logger.info('Ticker (%s,%s) not found.' % (source, ticker))
+            return None
+        instrument = self.instruments[self.ticker_index[(source, ticker)]]
+        properties = copy.deepcopy(instrument['properties'])
+        if props_fields is not None:
+            properties = {key: properties[key] for key in props_fields if key in properties}
+        series = {}
+        for key, _ in select_series_refs(instrument['series'], series_keys):
+            times, values = self.get_arrays(source, ticker, key, series_from, series_to)
+            if len(times) > 0:
+                series[key] = [list(sample) for sample in zip(epoch_ms_to_datetimes(times.view(numpy.int64)),
+                                                              values.tolist())]
+        return dict(tickers=[[source, ticker], ], properties=properties, series=series)
+
+    def get_arrays(self, source: str, ticker: str, series_key: str,
+                   series_from=datetime.datetime.min, series_to=datetime.datetime.max):
+        """Return a series as a pair of read-only arrays (datetime64[ms] times, values) without copying.
+
+        The values array has the dtype of the series (float64, int64 or bool)."""
+        empty = numpy.zeros(0, dtype='datetime64[ms]'), numpy.zeros(0, dtype=numpy.float64)
+        if (source, ticker) not in self.ticker_index:
+            return empty
+        instrument = self.instruments[self.ticker_index[(source, ticker)]]
+        if series_key not in instrument['series']:
+            return empty
+        offset, length, dtype = instrument['series'][series_key]
+        times = self.times[dtype][offset:offset + length]
+        lower, upper = datetimes_to_epoch_ms([series_from, series_to])
+        start = offset + numpy.searchsorted(times, lower, side='left')
+        end = offset + numpy.searchsorted(times, upper, side='right')
+        return self.times[dtype][start:end].view('datetime64[ms]'), self.values[dtype][start:end]
+
+    def __check_now(self, now):
+        if now is not None and now != self.now:
+            self.logger.error('The local snapshot is only available for %s.' % str(self.now))
+            return False
+        return True
@@ -0,0 +1,268 @@
+import collections
+import concurrent.futures
+import http.server
+import json
+import logging
+import threading
+import time
+import urllib.parse
+import signaldb
+
+QUERIES = ('get', 'get_many', 'list_tickers', 'find_instruments', 'get_latest')
+DATETIME_PARAMS = ('now', 'series_from', 'series_to')
+JSON_PARAMS = ('tickers', 'series_keys', 'props_fields', 'filter', 'n')
+
+logger = logging.getLogger(__name__)
+
+
+def run_query(sdb, name: str, params: dict):
+    """Run a read-only query given by its name and a dict of parameters and return a list of results.
+
+    Time stamps can be given as RFC 3339 strings. Raise ValueError for unknown queries, wrong parameters or failed
+    queries."""
+    if name not in QUERIES:
+        raise ValueError('Unknown query %s' % name)
+    if type(params) is not dict:
+        raise ValueError('Query parameters must be given as a json object')
+    params = dict(params)
+    for key in DATETIME_PARAMS:
+        if key in params and type(params[key]) is str:
+            try:
+                params[key] = signaldb.str_to_datetime(params[key])
+            except (AttributeError, TypeError, ValueError):
+                raise ValueError('Parameter %s is not a valid time stamp' % key)
+    if 'tickers' in params:
+        tickers = params['tickers']
+        if type(tickers) is not list or not all(type(ticker) in (list, tuple) and len(ticker) == 2 and
+                                                all(type(part) is str for part in ticker) for ticker in tickers):
+            raise ValueError('Parameter tickers must be a list of [source, ticker] pairs')
+        params['tickers'] = [tuple(ticker) for ticker in tickers]
+    if 'filter' in params and type(params['filter']) is not dict:
+        raise ValueError('Parameter filter must be a json object')
+    try:
+        if name == 'get':
+            results = [sdb.get(**params)]
+        elif name == 'get_many':
+            results = sdb.get_many(params.pop('tickers', []), **params)
+        elif name == 'list_tickers':
+            results = sdb.list_tickers(**params)
+        elif name == 'find_instruments':
+            results = sdb.find_instruments(params.pop('filter', {}), **params)
+        else:
+            results = sdb.get_latest(params.pop('tickers', []), **params)
+    except TypeError as e:
+        raise ValueError('Wrong parameters for %s: %s' % (name, str(e)))
+    if results is None:
+        raise ValueError('Query %s failed' % name)
+    return results
+
+
+def run_batch(sdb, input_fp, output_fp):
+    """Answer a stream of queries given as json lines {"query": <name>, "params": {...}, "id": <optional>}.
+
+    Each query is answered with one json line {"id": ..., "results": [...]} or {"id": ..., "error": "..."}, written
+    and flushed before the next query is read. A failing query does not stop the batch. Return the number of failed
+    queries."""
+    errors = 0
+    for line in input_fp:
+        if len(line.strip()) == 0:
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            if type(request) is not dict:
+                raise ValueError('Queries must be given as json objects')
+            request_id = request.get('id', None)
+            response = {'id': request_id, 'results': run_query(sdb, request.get('query', ''),
+                                                              request.get('params', {}))}
+        except ValueError as e:
+            errors += 1
+            response = {'id': request_id, 'error': str(e)}
+        except Exception as e:
+            logger.exception('Query failed')
+            errors += 1
+            response = {'id': request_id, 'error': 'Query failed: %s' % str(e)}
+        output_fp.write(json.dumps(response, separators=(',', ':'), cls=signaldb.JSONEncoderExtension) + '\n')
+        output_fp.flush()
+    return errors
+
+
+class QueryService:
+    """Runs queries against a shared SignalDb object.
+
+    Responses are cached as encoded json lines, up to cache_bytes in total; responses larger than
+    max_cached_response bytes are streamed but not cached. The cache is dropped whenever the db revision changes
+    (polled at most every revision_poll seconds). Identical queries running at the same time are coalesced into one
+    db query."""
+    def __init__(self, sdb, cache_bytes=64 * 2 ** 20, max_cached_response=2 ** 20, revision_poll=1.0):
+        self.sdb = sdb
+        self.cache_bytes = cache_bytes
+        self.max_cached_response = max_cached_response
+        self.revision_poll = revision_poll
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.in_flight = {}
+        self.revision = None
+        self.revision_time_stamp = 0.0
+        self.metrics = dict(queries=0, cache_hits=0, coalesced=0, db_queries=0)
+
+    def query(self, name: str, params: dict):
+        """Return the results of a query as an iterable of json lines (bytes).
+
+        Uncached results are encoded one line at a time while the returned iterable is consumed. Errors of the query
+        itself are raised by this call, before any line is returned."""
+        revision = self.get_revision()
+        key = (revision, name, json.dumps(params, sort_keys=True, cls=signaldb.JSONEncoderExtension))
+        with self.lock:
+            self.metrics['queries'] += 1
+            if key in self.cache:
+                self.metrics['cache_hits'] += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            future = self.in_flight.get(key, None)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self.in_flight[key] = future
+                self.metrics['db_queries'] += 1
+            else:
+                self.metrics['coalesced'] += 1
+        if not owner:
+            lines = future.result()
+            if lines is not None:
+                return lines
+            # The response was not kept (too large or not fully read): run the query again
+            with self.lock:
+                self.metrics['db_queries'] += 1
+            return (encode_line(result) for result in run_query(self.sdb, name, params))
+        try:
+            results = run_query(self.sdb, name, params)
+        except Exception as e:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+        lines = self.__stream(key, future, results)
+        # Enter the generator, so that dropping it unread still releases the coalesced queries
+        next(lines)
+        return lines
+
+    def __stream(self, key, future, results):
+        """Yield the encoded results and cache them if they are read completely and small enough"""
+        lines = []
+        size = 0
+        complete = False
+        try:
+            yield None
+            for result in results:
+                line = encode_line(result)
+                if lines is not None:
+                    size += len(line)
+                    if size <= self.max_cached_response:
+                        lines.append(line)
+                    else:
+                        lines = None
+                yield line
+            complete = True
+        finally:
+            if not complete:
+                lines = None
+            with self.lock:
+                self.in_flight.pop(key, None)
+                if lines is not None and key[0] == self.revision:
+                    self.cache[key] = lines
+                    self.cached_bytes += size
+                    while self.cached_bytes > self.cache_bytes:
+                        _, evicted = self.cache.popitem(last=False)
+                        self.cached_bytes -= sum(len(line) for line in evicted)
+            future.set_result(lines)
+
+    def get_revision(self):
+        with self.lock:
+            if time.monotonic() - self.revision_time_stamp < self.revision_poll:
+                return self.revision
+        revision = self.sdb.get_revision()
+        with self.lock:
+            if revision != self.revision:
+                self.cache.clear()
+                self.cached_bytes = 0
+                self.revision = revision
+            self.revision_time_stamp = time.monotonic()
+        return revision
+
+
+def encode_line(obj):
+    return (json.dumps(obj, separators=(',', ':'), cls=signaldb.JSONEncoderExtension) + '\n').encode('utf-8')
+
+
+class QueryRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answers GET /<query>?param=<value>&... and POST /<query> with a json object of parameters.
+
+    GET parameters are strings except for the list and object parameters in JSON_PARAMS, which are json values."""
+    service = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = {}
+        for key, value in urllib.parse.parse_qsl(url.query):
+            if key not in JSON_PARAMS:
+                params[key] = value
+                continue
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                self.send_error(400, 'Parameter %s is not valid json' % key)
+                return
+        self.__answer(url.path, params)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length).decode('utf-8')) if length > 0 else {}
+        except ValueError:
+            self.send_error(400, 'Cannot parse the request body')
+            return
+        self.__answer(urllib.parse.urlsplit(self.path).path, params)
+
+    def __answer(self, path: str, params):
+        name = path.strip('/')
+        if name not in QUERIES:
+            self.send_error(404, 'Unknown query')
+            return
+        try:
+            lines = self.service.query(name, params)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception:
+            logger.exception('Query %s failed' % name)
+            self.send_error(500, 'Query failed')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for line in lines:
+                self.wfile.write(line)
+        except Exception:
+            # The status is already sent; the response is cut short by closing the connection
+            logger.exception('Query %s failed while streaming' % name)
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s' % (self.address_string(), format % args))
+
+
+def serve(sdb, host='127.0.0.1', port=8080, cache_bytes=64 * 2 ** 20, max_cached_response=2 ** 20, revision_poll=1.0):
+    """Serve read-only queries over HTTP until interrupted"""
+    service = QueryService(sdb, cache_bytes, max_cached_response, revision_poll)
+    handler = type('Handler', (QueryRequestHandler, ), {'service': service})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    logger.info('Serving queries on http://%s:%d/' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
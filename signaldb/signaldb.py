@@ -9,16 +9,51 @@ import signaldb
 
 
 class SignalDb:
-    def __init__(self, db):
+    partition_schemes = [None, 'year']
+    indexes_version = 1
+
+    def __init__(self, db, partition_by=None):
+        """Connect to a signaldb database.
+
+        With partition_by='year' observations are stored in per-year collections (sheets_2019, sheets_2020, ...)
+        chosen by the observation time t. The partitioning scheme is recorded in the db when the first SignalDb
+        object with a partition_by argument is created for an empty sheets collection, and is used by all later
+        connections. Indexes are only created if the meta collection does not record them for indexes_version."""
         self.logger = logging.getLogger(__name__)
         self.db = db
         self.refs_col = 'refs'
         self.paths_col = 'paths'
         self.sheets_col = 'sheets'
         self.spaces_col = 'spaces'
+        self.meta_col = 'meta'
         self.source_max_len = 256
         self.ticker_max_len = 256
+        self.bulk_write_size = 100000
+        self.partition_by = self.__init_partition_scheme(partition_by)
+        if not self.indexes_exist():
+            self.create_indexes()
+
+    def __init_partition_scheme(self, partition_by):
+        if partition_by not in self.partition_schemes:
+            raise ValueError('Unsupported partitioning scheme %s' % partition_by)
+        try:
+            meta = self.db[self.meta_col].find_one({'_id': self.sheets_col})
+            if meta is not None:
+                if partition_by is not None and partition_by != meta['partition_by']:
+                    raise ValueError('The db uses the partitioning scheme %s' % meta['partition_by'])
+                return meta['partition_by']
+            if partition_by is not None:
+                if self.db[self.sheets_col].find_one() is not None:
+                    raise ValueError('The db holds unpartitioned observations')
+                self.db[self.meta_col].replace_one({'_id': self.sheets_col},
+                                                   {'_id': self.sheets_col, 'partition_by': partition_by}, upsert=True)
+        except pymongo.errors.OperationFailure:
+            self.logger.error('Cannot access the db')
+            raise ConnectionAbortedError('Cannot access the db')
+        return partition_by
 
+    def create_indexes(self):
+        """Create the indexes of all collections (no-op for existing indexes) and record the index version"""
         try:
             self.db[self.refs_col].create_index(
                 [('source', pymongo.ASCENDING), ('ticker', pymongo.ASCENDING)], unique=True, name='source_ticker_index')
@@ -26,40 +61,111 @@ class SignalDb:
             self.db[self.paths_col].create_index(
                 [('k', pymongo.ASCENDING), ('r', pymongo.ASCENDING)],
                 unique=True, name='k_r_index')
-            self.db[self.sheets_col].create_index(
-                [('k', pymongo.ASCENDING), ('t', pymongo.ASCENDING), ('r', pymongo.ASCENDING)],
-                unique=True, name='k_t_r_index')
+            for col in self.sheets_cols():
+                self.__create_sheets_index(col)
+            self.db[self.meta_col].replace_one({'_id': 'indexes'}, {'_id': 'indexes', 'version': self.indexes_version},
+                                               upsert=True)
         except pymongo.errors.OperationFailure:
             self.logger.error('Cannot access the db')
             raise ConnectionAbortedError('Cannot access the db')
 
+    def indexes_exist(self):
+        """Return True if create_indexes already ran for the current index version (recorded in the meta collection)"""
+        try:
+            meta = self.db[self.meta_col].find_one({'_id': 'indexes'})
+        except pymongo.errors.OperationFailure:
+            self.logger.error('Cannot access the db')
+            raise ConnectionAbortedError('Cannot access the db')
+        return meta is not None and meta.get('version', None) == self.indexes_version
+
+    def __create_sheets_index(self, col):
+        self.db[col].create_index(
+            [('k', pymongo.ASCENDING), ('t', pymongo.ASCENDING), ('r', pymongo.ASCENDING)],
+            unique=True, name='k_t_r_index')
+
+    def drop_indexes(self):
+        """Drop the indexes of all collections, e.g. before a bulk load"""
+        self.db[self.meta_col].delete_one({'_id': 'indexes'})
+        for col in [self.refs_col, self.paths_col] + self.sheets_cols():
+            self.db[col].drop_indexes()
+
+    def sheets_cols(self, lower_bound=datetime.datetime.min, upper_bound=datetime.datetime.max, cols=None):
+        """Return the names of the sheets collections which may hold observations between the bounds, in time order.
+
+        The partitions are listed on the server unless cols, the result of an earlier call without bounds, is given.
+        They are not cached between calls, so that partitions created by other connections are visible at once."""
+        if self.partition_by is None:
+            return [self.sheets_col]
+        if cols is not None:
+            partitions = cols
+        else:
+            partitions = self.db.list_collection_names(filter={'name': {'$regex': '^%s_\\d{4}$' % self.sheets_col}})
+        lower_name = self.sheets_col_for(lower_bound)
+        upper_name = self.sheets_col_for(upper_bound)
+        return sorted(col for col in partitions if lower_name <= col <= upper_name)
+
+    def sheets_col_for(self, t: datetime.datetime):
+        """Return the name of the sheets collection for observations at the time t"""
+        if self.partition_by is None:
+            return self.sheets_col
+        return '%s_%04d' % (self.sheets_col, t.year)
+
+    def drop_partition(self, col: str):
+        """Drop a sheets partition with all its observations"""
+        if col not in self.sheets_cols() or col == self.sheets_col:
+            self.logger.error('%s is not a sheets partition' % col)
+            return False
+        self.db[col].drop()
+        self.touch_revision()
+        return True
+
     def purge_db(self):
         """Remove all data from the database."""
         self.logger.debug('Removing all data from the db.')
-        if self.refs_col in self.db.collection_names():
+        col_names = self.db.list_collection_names()
+        if self.refs_col in col_names:
             self.db[self.refs_col].delete_many({})
-        if self.paths_col in self.db.collection_names():
+        if self.paths_col in col_names:
             self.db[self.paths_col].delete_many({})
-        if self.sheets_col in self.db.collection_names():
-            self.db[self.sheets_col].delete_many({})
-        if self.spaces_col in self.db.collection_names():
+        for col in self.sheets_cols():
+            if col in col_names:
+                self.db[col].delete_many({})
+        if self.spaces_col in col_names:
             self.db[self.spaces_col].delete_many({})
+        self.touch_revision()
 
     def rollback(self, time_stamp_str):
         """Restore the state of the database at the specified time"""
         time_stamp = signaldb.str_to_datetime(time_stamp_str)
-        if self.refs_col in self.db.collection_names():
+        col_names = self.db.list_collection_names()
+        if self.refs_col in col_names:
             self.db[self.refs_col].delete_many({'valid_from': {'$gt': time_stamp}})
-        if self.paths_col in self.db.collection_names():
+        if self.paths_col in col_names:
             self.db[self.paths_col].delete_many({'r': {'$gt': time_stamp}})
-        if self.sheets_col in self.db.collection_names():
-            self.db[self.sheets_col].delete_many({'r': {'$gt': time_stamp}})
-        if self.spaces_col in self.db.collection_names():
+        for col in self.sheets_cols():
+            if col in col_names:
+                self.db[col].delete_many({'r': {'$gt': time_stamp}})
+        if self.spaces_col in col_names:
             self.db[self.spaces_col].delete_many({'r': {'$gt': time_stamp}})
+        self.touch_revision()
+
+    def get_revision(self):
+        """Return the db revision number, which is increased by every write"""
+        revision = self.db[self.meta_col].find_one({'_id': 'revision'})
+        if revision is None:
+            return 0
+        return revision['n']
+
+    def touch_revision(self, now=None):
+        """Increase the db revision number"""
+        if now is None:
+            now = signaldb.get_utc_now()
+        self.db[self.meta_col].update_one({'_id': 'revision'}, {'$inc': {'n': 1}, '$set': {'r': now}}, upsert=True)
 
     def count_items(self):
-        """Return a triple giving the document count in each collection"""
-        return self.db[self.refs_col].count(), self.db[self.paths_col].count(), self.db[self.sheets_col].count()
+        """Return a triple giving the (estimated, from collection metadata) document count in each collection"""
+        return self.db[self.refs_col].estimated_document_count(), self.db[self.paths_col].estimated_document_count(), \
+            sum(self.db[col].estimated_document_count() for col in self.sheets_cols())
 
     def delete(self, source: str, ticker: str):
         """Delete an instrument"""
@@ -73,6 +179,7 @@ class SignalDb:
             return False
         ticker_record['valid_until'] = now
         self.db[self.refs_col].replace_one({'_id': ticker_record['_id']}, ticker_record, upsert=False)
+        self.touch_revision(now)
         return True
 
     def list_tickers(self, source='', now=None):
@@ -103,7 +210,7 @@ class SignalDb:
         return ticker_list
 
     def find_instruments(self, filter_doc: dict, series_from=datetime.datetime.min, series_to=datetime.datetime.max,
-                         now=None):
+                         now=None, series_keys=None, props_fields=None):
         """Search for instruments based on properties"""
         now = self.set_now(now)
         if now is None:
@@ -115,8 +222,11 @@ class SignalDb:
         pipeline.append({'$match': prop_filter})
         pipeline.append({'$sort': {'r': pymongo.ASCENDING}})
         pipeline.append({'$group': {'_id': '$k', 'v': {'$last': '$v'}}})
+        if props_fields is not None:
+            pipeline.append({'$project': self.__props_projection(props_fields)})
         cursor = self.db[self.paths_col].aggregate(pipeline=pipeline)
 
+        cols = self.sheets_cols()
         instruments = []
         for props in cursor:
             instrument = dict()
@@ -130,31 +240,40 @@ class SignalDb:
                 if series_id is None:
                     series_id = ticker['series']
             instrument['tickers'] = tickers
-            instrument['properties'] = props['v']
+            instrument['properties'] = props.get('v', {})
             if len(instrument['tickers']) == 0:
                 self.logger.warning('An instrument without tickers found: %s' % props['_id'])
+            series = None
             if series_id is not None:
-                instrument['series'] = self.__get_series(series_id, series_from, series_to, now)
-            else:
-                instrument['series'] = {}
+                series = self.__get_series(series_id, series_from, series_to, now, series_keys, cols)
+            instrument['series'] = series if series is not None else {}
             if len(instrument['series'].keys()) == 0 and \
                     (series_from != datetime.datetime.min or series_to != datetime.datetime.max):
                 continue
             instruments.append(instrument)
         return instruments
 
-    def get_many(self, ticker_list, now=None, series_from=datetime.datetime.min, series_to=datetime.datetime.max):
+    def get_many(self, ticker_list, now=None, series_from=datetime.datetime.min, series_to=datetime.datetime.max,
+                 series_keys=None, props_fields=None):
         """Get instruments from db and return them in the standard form"""
         if type(ticker_list) is list:
+            cols = self.sheets_cols()
             instruments = []
             for source, ticker in ticker_list:
-                instruments.append(self.get(source, ticker, now, series_from, series_to))
+                instruments.append(self.__get(source, ticker, now, series_from, series_to, series_keys, props_fields,
+                                              cols))
             return instruments
         raise ValueError('Ticker_list argument is not a list')
 
     def get(self, source: str, ticker: str, now=None,
-            series_from=datetime.datetime.min, series_to=datetime.datetime.max):
-        """Get a single instrument and return it in the standard form"""
+            series_from=datetime.datetime.min, series_to=datetime.datetime.max, series_keys=None, props_fields=None):
+        """Get a single instrument and return it in the standard form.
+
+        If series_keys is given, only the listed series are read from the db. If props_fields is given, only the
+        listed properties are returned."""
+        return self.__get(source, ticker, now, series_from, series_to, series_keys, props_fields, self.sheets_cols())
+
+    def __get(self, source, ticker, now, series_from, series_to, series_keys, props_fields, cols):
         now = self.set_now(now)
         if now is None:
             return None
@@ -165,20 +284,159 @@ class SignalDb:
             self.logger.info('Ticker (%s,%s) not found.' % (source, ticker))
             return None
         instrument = dict(tickers=[[source, ticker], ])
+        projection = None
+        if props_fields is not None:
+            projection = self.__props_projection(props_fields)
         properties_record = self.db[self.paths_col].find_one({'k': ticker_record['props'], 'r': {'$lte': now}},
-                                                             sort=[('r', pymongo.DESCENDING)])
+                                                             projection, sort=[('r', pymongo.DESCENDING)])
         if properties_record is None:
             self.logger.warning('The ticker (%s,%s) points to a non-existent properties document.' % (source, ticker))
             instrument['properties'] = {}
         else:
-            instrument['properties'] = properties_record['v']
-        series = self.__get_series(ticker_record['series'], series_from, series_to, now)
+            instrument['properties'] = properties_record.get('v', {})
+        series = self.__get_series(ticker_record['series'], series_from, series_to, now, series_keys, cols)
         if series is None:
             series = {}
         instrument['series'] = series
         return instrument
 
-    def __get_series(self, series_id, series_from, series_to, now):
+    def get_latest(self, ticker_list, series_keys=None, now=None, n=1):
+        """Get the last n observations of the selected series for a list of tickers.
+
+        Return a list with an instrument in the standard form (without properties) for each (source, ticker) pair,
+        or None if the ticker is not found."""
+        now = self.set_now(now)
+        if now is None:
+            return None
+        if type(ticker_list) is not list:
+            raise ValueError('Ticker_list argument is not a list')
+        if type(n) is not int or n < 1:
+            self.logger.error('The number of observations must be a positive integer')
+            return None
+        ticker_records = self.__find_refs(ticker_list, now)
+        series_refs = self.__get_series_refs_many([r['series'] for r in ticker_records.values()], now)
+        cols = self.sheets_cols()
+        tails = {}
+        instruments = []
+        for source, ticker in ticker_list:
+            ticker_record = ticker_records.get((source, ticker), None)
+            if ticker_record is None:
+                self.logger.info('Ticker (%s,%s) not found.' % (source, ticker))
+                instruments.append(None)
+                continue
+            series = {}
+            for key, series_key in select_series_refs(series_refs.get(ticker_record['series'], {}), series_keys):
+                if series_key not in tails:
+                    tails[series_key] = self.__get_series_tail(series_key, now, n, cols)
+                if len(tails[series_key]) > 0:
+                    series[key] = tails[series_key]
+            instruments.append(dict(tickers=[[source, ticker], ], series=series))
+        return instruments
+
+    def get_panel(self, ticker_list, series_key: str, series_from=datetime.datetime.min,
+                  series_to=datetime.datetime.max, now=None, chunk_size=1000):
+        """Get a series for a list of tickers as an aligned time x instrument matrix.
+
+        Return a pair (times, values), where times is a sorted datetime64[ms] array holding the union of all
+        observation times and values is a float64 array of shape (len(times), len(ticker_list)) with NaN for missing
+        observations. The observations are aggregated in chunks of chunk_size series."""
+        import numpy  # imported on use to keep the start-up of the sdb command short
+        now = self.set_now(now)
+        if now is None:
+            return None
+        if type(ticker_list) is not list:
+            raise ValueError('Ticker_list argument is not a list')
+        ticker_records = self.__find_refs(ticker_list, now)
+        series_refs = self.__get_series_refs_many([r['series'] for r in ticker_records.values()], now)
+        column_keys = []
+        for source, ticker in ticker_list:
+            ticker_record = ticker_records.get((source, ticker), None)
+            if ticker_record is None:
+                self.logger.info('Ticker (%s,%s) not found.' % (source, ticker))
+                column_keys.append(None)
+                continue
+            column_keys.append(series_refs.get(ticker_record['series'], {}).get(series_key, None))
+
+        columns = {}
+        series_keys = list(set(key for key in column_keys if key is not None))
+        for col in self.sheets_cols(series_from, series_to):
+            for i in range(0, len(series_keys), chunk_size):
+                try:
+                    chunk_columns = self.__get_series_columns(col, series_keys[i:i + chunk_size], now,
+                                                              series_from, series_to)
+                except (TypeError, ValueError):
+                    self.logger.error('Series %s contains non-numeric values.' % series_key)
+                    return None
+                for key, (times, values) in chunk_columns.items():
+                    if key in columns:
+                        # partitions are disjoint in time and visited in time order
+                        times = numpy.concatenate([columns[key][0], times])
+                        values = numpy.concatenate([columns[key][1], values])
+                    columns[key] = times, values
+
+        if len(columns) > 0:
+            times = numpy.unique(numpy.concatenate([column[0] for column in columns.values()]))
+        else:
+            times = numpy.zeros(0, dtype='datetime64[ms]')
+        values = numpy.full((len(times), len(ticker_list)), numpy.nan)
+        for j, key in enumerate(column_keys):
+            if key in columns:
+                values[numpy.searchsorted(times, columns[key][0]), j] = columns[key][1]
+        return times, values
+
+    def __get_series_columns(self, col, series_keys, now, lower_bound, upper_bound):
+        """Return a dict mapping series keys to (datetime64[ms] times, float64 values) arrays sorted by time.
+
+        Raise ValueError for values which are not ints or floats."""
+        import numpy
+        pipeline = list()
+        pipeline.append({'$match': {'k': {'$in': series_keys}, 'r': {'$lte': now},
+                                    '$and': [{'t': {'$lte': upper_bound}}, {'t': {'$gte': lower_bound}}]}})
+        pipeline.append({'$sort': {'k': pymongo.ASCENDING, 't': pymongo.ASCENDING, 'r': pymongo.ASCENDING}})
+        pipeline.append({'$group': {'_id': {'k': '$k', 't': '$t'}, 'v': {'$last': '$v'}}})
+        cursor = self.db[col].aggregate(pipeline=pipeline, allowDiskUse=True)
+        observations = {}
+        for item in cursor:
+            if type(item['v']) not in (int, float):
+                # numpy would silently convert bools, None and numeric strings
+                raise ValueError('Non-numeric value %r' % (item['v'], ))
+            times, values = observations.setdefault(item['_id']['k'], ([], []))
+            times.append(item['_id']['t'])
+            values.append(item['v'])
+        columns = {}
+        for key, (times, values) in observations.items():
+            times = numpy.array(times, dtype='datetime64[ms]')
+            order = numpy.argsort(times)
+            columns[key] = times[order], numpy.array(values, dtype=numpy.float64)[order]
+        return columns
+
+    def __find_refs(self, ticker_list, now):
+        """Return a dict mapping (source, ticker) pairs to the ticker records valid at now"""
+        pairs = set((source, ticker) for source, ticker in ticker_list)
+        if len(pairs) == 0:
+            return {}
+        filter_doc = {'source': {'$in': list(set(p[0] for p in pairs))},
+                      'ticker': {'$in': list(set(p[1] for p in pairs))},
+                      'valid_from': {'$lte': now}, 'valid_until': {'$gte': now}}
+        ticker_records = {}
+        for ticker_record in self.db[self.refs_col].find(filter_doc):
+            pair = (ticker_record['source'], ticker_record['ticker'])
+            if pair in pairs:
+                ticker_records[pair] = ticker_record
+        return ticker_records
+
+    def __get_series_refs_many(self, series_ids, now):
+        """Return a dict mapping series ids to the series refs (key -> series key) valid at now"""
+        if len(series_ids) == 0:
+            return {}
+        pipeline = list()
+        pipeline.append({'$match': {'k': {'$in': list(set(series_ids))}, 'r': {'$lte': now}}})
+        pipeline.append({'$sort': {'r': pymongo.ASCENDING}})
+        pipeline.append({'$group': {'_id': '$k', 'v': {'$last': '$v'}}})
+        cursor = self.db[self.paths_col].aggregate(pipeline=pipeline)
+        return {item['_id']: item['v'] for item in cursor}
+
+    def __get_series(self, series_id, series_from, series_to, now, series_keys, cols):
         series_refs = self.db[self.paths_col].find_one({'k': series_id, 'r': {'$lte': now}},
                                                        sort=[('r', pymongo.DESCENDING)])
         if series_refs is None:
@@ -186,12 +444,20 @@ class SignalDb:
         if len(series_refs['v']) == 0:
             return None
         series = {}
-        for ref in series_refs['v'].items():
-            observations = self.__get_series_by_key(ref[1], now, series_from, series_to)
+        for ref in select_series_refs(series_refs['v'], series_keys):
+            observations = self.__get_series_by_key(ref[1], now, cols, series_from, series_to)
             if len(observations) > 0:
                 series[ref[0]] = observations
         return series
 
+    @staticmethod
+    def __props_projection(props_fields):
+        """Return a projection doc selecting the given properties of a path obj"""
+        projection = {'v.' + field: 1 for field in props_fields}
+        if len(projection) == 0:
+            projection['_id'] = 1
+        return projection
+
     def __validate_source_ticker(self, source: str, ticker: str):
         return self.__validate_label(source, self.source_max_len, 'source') and \
                self.__validate_label(ticker, self.ticker_max_len, 'ticker')
@@ -208,52 +474,63 @@ class SignalDb:
         return True
 
     def upsert(self, instruments, props_merge_mode='append', series_merge_mode='append',
-               consolidate_flag=True):
-        """Update or insert a list of instruments."""
+               consolidate_flag=True, processes=None):
+        """Update or insert a list of instruments.
+
+        All instruments are written with the same revision time stamp and their observations are collected into
+        bulk writes of up to bulk_write_size documents."""
         if series_merge_mode not in ['append', 'replace']:
             self.logger.error('Requested series merge mode is not supported yet.')
             return False
         if type(instruments) is not list:
             instruments = [instruments, ]
         if consolidate_flag:
-            consolidated_instruments = self.consolidate(instruments, props_merge_mode)
+            consolidated_instruments = self.consolidate(instruments, props_merge_mode, processes)
         else:
             consolidated_instruments = instruments
         if consolidated_instruments is None:
             return False
+        now = signaldb.get_utc_now()
+        cols = self.sheets_cols()
+        flat_series = []
+        pending_series_ids = set()
         for instrument in consolidated_instruments:
-            self.__upsert_instrument(instrument, props_merge_mode, series_merge_mode)
+            main_ref = self.__find_one_ref(instrument['tickers'], now)
+            if main_ref is not None and main_ref['series'] in pending_series_ids:
+                # Another ticker of the same instrument was processed in this batch. Write its observations before
+                # merging, otherwise they are merged against the db state without them.
+                cols = self.__upsert_series(flat_series, cols)
+                flat_series = []
+                pending_series_ids = set()
+            series_id, instrument_series = self.__upsert_instrument(instrument, main_ref, props_merge_mode,
+                                                                    series_merge_mode, now, cols)
+            flat_series.extend(instrument_series)
+            pending_series_ids.add(series_id)
+            if len(flat_series) >= self.bulk_write_size:
+                cols = self.__upsert_series(flat_series, cols)
+                flat_series = []
+                pending_series_ids = set()
+        self.__upsert_series(flat_series, cols)
+        self.touch_revision(now)
         return True
 
-    def consolidate(self, instruments, props_merge_mode='append'):
-        """Consolidate the instrument"""
+    def consolidate(self, instruments, props_merge_mode='append', processes=None):
+        """Consolidate the instrument. The instruments are checked in parallel if processes > 1."""
         if props_merge_mode not in ['append', 'replace']:
             self.logger.error('Requested properties merge mode is not supported yet.')
             return None
         if type(instruments) is not list:
             self.logger.error('upsert: supplied instrument data is not a list.')
             return None
-        xauldron.rfc3339.recursive_str_to_datetime(instruments)
-        checked_instruments = []
-        for i, instrument in enumerate(instruments):
-            check_result = xauldron.finstruments.check(instrument)
-            if check_result != 0:
-                self.logger.error('Supplied instrument has wrong type (index no %d; failed test %d).' %
-                                  (i + 1, check_result))
-                continue
-            checked_instruments.append(instrument)
-        return xauldron.finstruments.consolidate(checked_instruments, props_merge_mode)
-
-    def __upsert_instrument(self, instrument, props_merge_mode, series_merge_mode):
-        """Update or insert an instrument"""
-        now = signaldb.get_utc_now()
-        main_ref = self.__find_one_ref(instrument['tickers'], now)
+        import signaldb.consolidation  # imports numpy and multiprocessing, only needed for writes
+        return signaldb.consolidation.consolidate(instruments, props_merge_mode, processes, self.logger)
 
+    def __upsert_instrument(self, instrument, main_ref, props_merge_mode, series_merge_mode, now, cols):
+        """Update or insert an instrument. Return its series refs id and the observations to be written."""
         if main_ref is None:
-            self.__insert_instrument(instrument, now)
-        else:
-            self.__update_instrument(instrument, main_ref, props_merge_mode, series_merge_mode, now)
-        return True
+            return self.__insert_instrument(instrument, now)
+        return main_ref['series'], self.__update_instrument(instrument, main_ref, props_merge_mode,
+                                                            series_merge_mode, now, cols)
 
     def __find_one_ref(self, tickers, now):
         for ticker in tickers:
@@ -265,7 +542,7 @@ class SignalDb:
         return None
 
     def __insert_instrument(self, instrument, now):
-        """Insert a new instrument into the db"""
+        """Insert a new instrument into the db. Return its series refs id and its observations to be written."""
         first_ticker = instrument['tickers'][0]
         self.logger.debug("Add new instrument with ticker (%s,%s)" % (first_ticker[0], first_ticker[1]))
 
@@ -292,10 +569,10 @@ class SignalDb:
             # TODO add revision-aware unwind (low priority)
             self.db[self.refs_col].delete_many({'_id': {'$in': [t['_id'] for t in refs_to_insert]}})
             raise
-        self.__upsert_series(flat_series)
+        return series_id, flat_series
 
-    def __update_instrument(self, instrument, main_ref, props_merge_mode, series_merge_mode, now):
-        """Merge the provided instrument with the data from the db"""
+    def __update_instrument(self, instrument, main_ref, props_merge_mode, series_merge_mode, now, cols):
+        """Merge the provided instrument with the data from the db. Return the observations to be written."""
         props = self.db[self.paths_col].find_one({'k': main_ref['props']}, sort=[('r', pymongo.DESCENDING)])
         if props is None:
             props = dict(k=main_ref['props'], r=now, v=instrument['properties'])
@@ -323,12 +600,12 @@ class SignalDb:
                                         't': sample[0], 'v': sample[1]})
             else:
                 lower_bound, upper_bound = get_series_time_bounds(instrument['series'][key])
-                db_lower_bound, db_upper_bound = self.__get_series_time_bounds(series_refs['v'][key], now)
+                db_lower_bound, db_upper_bound = self.__get_series_time_bounds(series_refs['v'][key], now, cols)
                 if db_upper_bound < lower_bound or upper_bound < db_lower_bound:
                     merged_series = instrument['series'][key]
                 else:
                     current_series_data = self.__get_series_by_key(series_refs['v'][key],
-                                                                   now, lower_bound, upper_bound, )
+                                                                   now, cols, lower_bound, upper_bound)
                     merged_series = merge_series(current_series_data, instrument['series'][key])
                 for sample in merged_series:
                     flat_series.append({'k': series_refs['v'][key], 'r': now,
@@ -343,24 +620,40 @@ class SignalDb:
         if update_series_refs:
             series_refs['r'] = now
             self.db[self.paths_col].replace_one(dict(k=series_refs['k'], r=now), series_refs, upsert=True)
-        self.__upsert_series(flat_series)
+        return flat_series
 
-    def __upsert_series(self, series):
-        """Insert a list of observations to the series col. Updates existing observations."""
+    def __upsert_series(self, series, cols):
+        """Insert a list of observations to the series col. Updates existing observations.
+
+        Return the list of sheets collections cols extended by the partitions created for the observations."""
         if len(series) == 0:
-            return
+            return cols
+        if self.partition_by is None:
+            self.__upsert_series_col(self.sheets_col, series)
+            return cols
+        partitioned_series = {}
+        for sample in series:
+            partitioned_series.setdefault(self.sheets_col_for(sample['t']), []).append(sample)
+        new_partitions = set(partitioned_series.keys()) - set(cols)
+        for col in new_partitions:
+            self.__create_sheets_index(col)
+        for col, col_series in partitioned_series.items():
+            self.__upsert_series_col(col, col_series)
+        return sorted(set(cols) | new_partitions)
+
+    def __upsert_series_col(self, col, series):
         try:
             # sheets_bulk_handle = self.db[self.sheets_col].initialize_unordered_bulk_op()
             # for item in series:
             #     sheets_bulk_handle.insert(item)
             # sheets_bulk_handle.execute()
-            self.db[self.sheets_col].insert_many(series)
+            self.db[col].insert_many(series)
         except pymongo.errors.BulkWriteError:
             self.logger.error("Bulk write error.")
             for sample in series:
                 sample.pop('_id', None)
-                self.db[self.sheets_col].find_one_and_replace(
-                    {'k': sample['k'], 't': sample['t']}, sample, upsert=True)
+                self.db[col].find_one_and_replace(
+                    {'k': sample['k'], 't': sample['t'], 'r': sample['r']}, sample, upsert=True)
 
     @staticmethod
     def __prepare_refs(tickers, now):
@@ -380,7 +673,7 @@ class SignalDb:
                              scenarios=scenarios_id))
         return refs
 
-    def __get_series_by_key(self, series_key, now, lower_bound=datetime.datetime.min,
+    def __get_series_by_key(self, series_key, now, cols, lower_bound=datetime.datetime.min,
                             upper_bound=datetime.datetime.max):
         series_aggr = []
         pipeline = list() # TODO array
@@ -389,12 +682,33 @@ class SignalDb:
         pipeline.append({'$sort': {'r': pymongo.ASCENDING}})
         pipeline.append({'$group': {'_id': '$t', 't': {'$last': '$t'}, 'v': {'$last': '$v'}}})
         pipeline.append({'$sort': {'t': pymongo.ASCENDING}})
-        cursor_aggr = self.db[self.sheets_col].aggregate(pipeline=pipeline)
-        for item in cursor_aggr:
-            series_aggr.append([item['t'], item['v']])
+        for col in self.sheets_cols(lower_bound, upper_bound, cols):
+            cursor_aggr = self.db[col].aggregate(pipeline=pipeline)
+            for item in cursor_aggr:
+                series_aggr.append([item['t'], item['v']])
         return series_aggr
 
-    def __get_series_time_bounds(self, series_key, now):
+    def __get_series_tail(self, series_key, now, n, cols):
+        """Return the last n observations of a series, reading the k_t_r index backwards"""
+        series_tail = []
+        for col in reversed(cols):
+            cursor = self.db[col].find({'k': series_key, 'r': {'$lte': now}}, {'_id': 0, 't': 1, 'v': 1},
+                                       sort=[('t', pymongo.DESCENDING), ('r', pymongo.DESCENDING)])
+            cursor.batch_size(n)
+            for item in cursor:
+                if len(series_tail) > 0 and series_tail[-1][0] == item['t']:
+                    # an older revision of an observation already taken
+                    continue
+                series_tail.append([item['t'], item['v']])
+                if len(series_tail) == n:
+                    break
+            cursor.close()
+            if len(series_tail) == n:
+                break
+        series_tail.reverse()
+        return series_tail
+
+    def __get_series_time_bounds(self, series_key, now, cols):
         """Return time bounds for a series"""
         lower_bound = datetime.datetime.min
         upper_bound = datetime.datetime.max
@@ -404,13 +718,17 @@ class SignalDb:
         pipeline.append({'$limit': 1})
         pipeline.append({'$project': {'t': 1}})
 
-        cursor = self.db[self.sheets_col].aggregate(pipeline=pipeline)
-        for item in cursor:
-            lower_bound = item['t']
+        for col in cols:
+            for item in self.db[col].aggregate(pipeline=pipeline):
+                lower_bound = item['t']
+            if lower_bound != datetime.datetime.min:
+                break
         pipeline[1] = {'$sort': {'t': pymongo.DESCENDING}}
-        cursor = self.db[self.sheets_col].aggregate(pipeline=pipeline)
-        for item in cursor:
-            upper_bound = item['t']
+        for col in reversed(cols):
+            for item in self.db[col].aggregate(pipeline=pipeline):
+                upper_bound = item['t']
+            if upper_bound != datetime.datetime.max:
+                break
         return lower_bound, upper_bound
 
     @staticmethod
@@ -436,6 +754,13 @@ def get_series_time_bounds(series: list):
     return min(times), max(times)
 
 
+def select_series_refs(series_refs: dict, series_keys=None):
+    """Return the (key, series id) pairs of a series refs doc, restricted to series_keys if given"""
+    if series_keys is None:
+        return list(series_refs.items())
+    return [(key, series_refs[key]) for key in series_keys if key in series_refs]
+
+
 def merge_series(old_series, new_series):
     old_series_dict = dict(old_series)
     new_series_dict = dict(new_series)
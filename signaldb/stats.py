@@ -0,0 +1,99 @@
+import pymongo
+import pymongo.errors
+
+
+def collection_stats(sdb):
+    """Return a list with the document count, data size, index sizes and index usage of each collection.
+
+    Index usage (ops) is None if it is not available to the db user."""
+    stats = []
+    for col in [sdb.refs_col, sdb.paths_col] + sdb.sheets_cols():
+        try:
+            col_stats = sdb.db.command('collStats', col)
+        except pymongo.errors.OperationFailure:
+            continue
+        index_usage = {}
+        try:
+            for item in sdb.db[col].aggregate([{'$indexStats': {}}]):
+                index_usage[item['name']] = item['accesses']['ops']
+        except pymongo.errors.OperationFailure:
+            # Requires the indexStats privilege; usage is reported as unknown (None)
+            pass
+        stats.append({'name': col,
+                      'count': col_stats.get('count', 0),
+                      'size': col_stats.get('size', 0),
+                      'storage_size': col_stats.get('storageSize', 0),
+                      'index_size': col_stats.get('totalIndexSize', 0),
+                      'indexes': {name: {'size': size, 'ops': index_usage.get(name, None)}
+                                  for name, size in col_stats.get('indexSizes', {}).items()}})
+    return stats
+
+
+def source_stats(sdb, now=None):
+    """Return a dict mapping each source to the number of its tickers and instruments valid at now"""
+    now = sdb.set_now(now)
+    if now is None:
+        return None
+    pipeline = list()
+    pipeline.append({'$match': {'valid_from': {'$lte': now}, 'valid_until': {'$gte': now}}})
+    # Group by instrument first, so no per-source array of instruments is built
+    pipeline.append({'$group': {'_id': {'source': '$source', 'series': '$series'}, 'tickers': {'$sum': 1}}})
+    pipeline.append({'$group': {'_id': '$_id.source', 'tickers': {'$sum': '$tickers'}, 'instruments': {'$sum': 1}}})
+    return {item['_id']: {'tickers': item['tickers'], 'instruments': item['instruments']}
+            for item in sdb.db[sdb.refs_col].aggregate(pipeline=pipeline, allowDiskUse=True)}
+
+
+def revision_stats(sdb, top=10):
+    """Return the number of revisions of the most often revised properties and series refs docs"""
+    pipeline = list()
+    pipeline.append({'$group': {'_id': '$k', 'revisions': {'$sum': 1}, 'last_revision': {'$max': '$r'}}})
+    pipeline.append({'$sort': {'revisions': pymongo.DESCENDING}})
+    pipeline.append({'$limit': top})
+    return list(sdb.db[sdb.paths_col].aggregate(pipeline=pipeline, allowDiskUse=True))
+
+
+def series_stats(sdb, top=10, sample_size=None):
+    """Return the heaviest series by number of stored observations (including old revisions).
+
+    Each item holds the series key, its tickers, the observation count and the number of revisions. With
+    sample_size only a random sample of observations of each sheets collection is aggregated, and the counts are
+    scaled to estimates."""
+    counts = {}
+    for col in sdb.sheets_cols():
+        pipeline = list()
+        scale = 1.0
+        if sample_size is not None:
+            col_count = sdb.db[col].estimated_document_count()
+            if col_count > sample_size:
+                pipeline.append({'$sample': {'size': sample_size}})
+                scale = col_count / sample_size
+        pipeline.append({'$group': {'_id': '$k', 'observations': {'$sum': 1}, 'revisions': {'$addToSet': '$r'}}})
+        pipeline.append({'$project': {'observations': 1, 'revisions': {'$size': '$revisions'}}})
+        for item in sdb.db[col].aggregate(pipeline=pipeline, allowDiskUse=True):
+            count = counts.setdefault(item['_id'], {'observations': 0, 'revisions': 0})
+            count['observations'] += item['observations'] * scale
+            count['revisions'] = max(count['revisions'], item['revisions'])
+    heaviest = sorted(counts.items(), key=lambda item: item[1]['observations'], reverse=True)[:top]
+    names = resolve_series_keys(sdb, [key for key, _ in heaviest])
+    heaviest_series = []
+    for key, count in heaviest:
+        tickers, name = names.get(key, ([], None))
+        heaviest_series.append(dict(series_key=key, tickers=tickers, name=name,
+                                    observations=int(round(count['observations'])), revisions=count['revisions']))
+    return heaviest_series
+
+
+def resolve_series_keys(sdb, series_keys):
+    """Return a dict mapping series keys to (tickers, series name) pairs"""
+    if len(series_keys) == 0:
+        return {}
+    pipeline = list()
+    pipeline.append({'$project': {'k': 1, 'v': {'$objectToArray': '$v'}}})
+    pipeline.append({'$unwind': '$v'})
+    pipeline.append({'$match': {'v.v': {'$in': series_keys}}})
+    pipeline.append({'$group': {'_id': '$v.v', 'series_id': {'$first': '$k'}, 'name': {'$first': '$v.k'}}})
+    paths = list(sdb.db[sdb.paths_col].aggregate(pipeline=pipeline, allowDiskUse=True))
+    tickers = {}
+    for ticker_record in sdb.db[sdb.refs_col].find({'series': {'$in': [item['series_id'] for item in paths]}}):
+        tickers.setdefault(ticker_record['series'], []).append([ticker_record['source'], ticker_record['ticker']])
+    return {item['_id']: (tickers.get(item['series_id'], []), item['name']) for item in paths}
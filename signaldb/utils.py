@@ -7,6 +7,9 @@ import pymongo
 from bson.objectid import ObjectId
 import os
 
+# Output formats of signaldb.formats (kept here, so that the sdb command does not need to import numpy on start-up)
+FORMATS = ('json', 'jsonl', 'npz')
+
 
 def truncate_microseconds(d: datetime.datetime):
     return d.replace(microsecond=(d.microsecond // 1000) * 1000)
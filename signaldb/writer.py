@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+import signaldb
+
+
+class BufferedWriter:
+    """Write-behind buffer for appending observations to series.
+
+    Samples passed to append are coalesced per series in memory and written by a background thread, either every
+    flush_interval seconds or as soon as max_batch_size samples are buffered. Each flush is a single upsert, so all
+    buffered samples share one revision time stamp. append blocks while max_pending samples are waiting to be
+    written (back-pressure). close (or leaving a with block) writes the remaining samples.
+
+    Samples of a failed write are put back into the buffer and retried with the next flush; flush and close raise
+    IOError if the samples could not be written.
+
+    New tickers are inserted as instruments with empty properties."""
+    def __init__(self, sdb, flush_interval=1.0, max_batch_size=10000, max_pending=100000):
+        if max_pending < max_batch_size:
+            raise ValueError('max_pending must not be smaller than max_batch_size')
+        self.logger = logging.getLogger(__name__)
+        self.sdb = sdb
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.buffer = {}
+        self.pending = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.metrics = dict(flushes=0, samples=0, max_batch_size=0, errors=0, failed_samples=0,
+                            write_seconds=0.0, blocked_seconds=0.0)
+        self.thread = threading.Thread(target=self.__run, name='signaldb-writer', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, source: str, ticker: str, series_key: str, samples: list):
+        """Buffer a list of samples [[t, v], ...] for a series. Later samples overwrite earlier ones with the same t."""
+        with self.condition:
+            if self.closed:
+                raise ValueError('The writer is closed')
+            if self.pending >= self.max_pending:
+                time_stamp = time.perf_counter()
+                self.condition.wait_for(lambda: self.pending < self.max_pending or self.closed)
+                self.metrics['blocked_seconds'] += time.perf_counter() - time_stamp
+                if self.closed:
+                    # the last flush may have run already, so the samples would never be written
+                    raise ValueError('The writer is closed')
+            series = self.buffer.setdefault((source, ticker), {}).setdefault(series_key, {})
+            for t, v in samples:
+                t = signaldb.truncate_microseconds(t)
+                if t not in series:
+                    self.pending += 1
+                series[t] = v
+            if self.pending >= self.max_batch_size:
+                self.condition.notify_all()
+
+    def flush(self):
+        """Write all buffered samples and wait until they are written. Raise IOError if the write fails."""
+        if not self.__flush_buffer():
+            raise IOError('Writing the buffered samples failed')
+
+    def close(self):
+        """Write the remaining samples and stop the background thread.
+
+        Raise IOError if samples could not be written; they are kept and can be retried with flush."""
+        with self.condition:
+            if not self.closed:
+                self.closed = True
+                self.condition.notify_all()
+        self.thread.join()
+        with self.condition:
+            pending = self.pending
+        if pending > 0:
+            raise IOError('%d samples could not be written' % pending)
+
+    def get_metrics(self):
+        """Return a dict with the flush count, written samples, batch sizes and timings"""
+        with self.condition:
+            metrics = dict(self.metrics, pending=self.pending)
+        metrics['mean_batch_size'] = metrics['samples'] / metrics['flushes'] if metrics['flushes'] > 0 else 0.0
+        return metrics
+
+    def __run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self.pending >= self.max_batch_size,
+                                        timeout=self.flush_interval)
+                closed = self.closed
+            written = self.__flush_buffer()
+            if closed:
+                return
+            if not written:
+                # Wait before retrying the failed batch
+                with self.condition:
+                    self.condition.wait_for(lambda: self.closed, timeout=self.flush_interval)
+
+    def __flush_buffer(self):
+        # Batches are taken and written under the write lock, so that they reach the db in order
+        with self.write_lock:
+            with self.condition:
+                batch, batch_size = self.buffer, self.pending
+                self.buffer = {}
+                self.pending = 0
+                self.condition.notify_all()
+            if self.__write(batch, batch_size):
+                return True
+            with self.condition:
+                self.__requeue(batch)
+            return False
+
+    def __requeue(self, batch: dict):
+        """Put the samples of a failed batch back into the buffer; samples appended in the meantime take precedence"""
+        for ticker_key, series in batch.items():
+            buffered_series = self.buffer.setdefault(ticker_key, {})
+            for series_key, samples in series.items():
+                buffered_samples = buffered_series.setdefault(series_key, {})
+                for t, v in samples.items():
+                    if t not in buffered_samples:
+                        buffered_samples[t] = v
+                        self.pending += 1
+
+    def __write(self, batch: dict, batch_size: int):
+        if batch_size == 0:
+            return True
+        instruments = []
+        for (source, ticker), series in batch.items():
+            instruments.append({'tickers': [[source, ticker], ], 'properties': {},
+                                'series': {key: [[t, samples[t]] for t in sorted(samples)]
+                                           for key, samples in series.items()}})
+        time_stamp = time.perf_counter()
+        try:
+            result = self.sdb.upsert(instruments, props_merge_mode='append', series_merge_mode='append',
+                                     consolidate_flag=False)
+        except Exception:
+            self.logger.exception('Writing %d samples failed.' % batch_size)
+            result = False
+        seconds = time.perf_counter() - time_stamp
+        with self.condition:
+            self.metrics['write_seconds'] += seconds
+            if not result:
+                self.metrics['errors'] += 1
+                self.metrics['failed_samples'] += batch_size
+                return False
+            self.metrics['flushes'] += 1
+            self.metrics['samples'] += batch_size
+            self.metrics['max_batch_size'] = max(self.metrics['max_batch_size'], batch_size)
+        self.logger.debug('Wrote %d samples of %d instruments in %fs.' % (batch_size, len(instruments), seconds))
+        return True
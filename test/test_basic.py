@@ -3,13 +3,38 @@
 # sys.path.insert(0, os.path.abspath('..'))
 import copy
 import datetime
+import http.server
+import io
+import json
 import logging
+import math
+import tempfile
+import threading
 import time
 import unittest
+import urllib.parse
+import urllib.request
 import signaldb
+import signaldb.dump
+import signaldb.local
+import signaldb.service
+import signaldb.stats
+import signaldb.writer
 import xauldron
 
 
+class FailingDb:
+    """SignalDb wrapper whose upserts fail while fail is set"""
+    def __init__(self, sdb):
+        self.sdb = sdb
+        self.fail = True
+
+    def upsert(self, *args, **kwargs):
+        if self.fail:
+            raise ConnectionError('The db is not available')
+        return self.sdb.upsert(*args, **kwargs)
+
+
 class SignalDbTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -182,6 +207,372 @@ class SignalDbTest(unittest.TestCase):
         self.assertTrue(self.db.upsert(instruments))
         self.compare_instruments_with_db(instruments)
 
+    def test_get_selection(self):
+        """Test the parameters series_keys and props_fields of the get function"""
+        instruments = xauldron.FinstrumentFaker.get(self.instruments_no)
+        for instrument in instruments:
+            instrument['series']['volume'] = xauldron.FinstrumentFaker.get_series()
+        self.assertTrue(self.db.upsert(instruments))
+        for instrument in instruments:
+            source, ticker = instrument['tickers'][0]
+            instrument_from_db = self.db.get(source, ticker, series_keys=['volume', 'nonexistent'],
+                                             props_fields=['company_name'])
+            self.assertListEqual(list(instrument_from_db['series'].keys()), ['volume'])
+            self.assertListEqual(instrument_from_db['series']['volume'], instrument['series']['volume'])
+            self.assertSetEqual(set(instrument_from_db['properties'].keys()),
+                                {'company_name'} & set(instrument['properties'].keys()))
+
+            instrument_from_db = self.db.get(source, ticker, series_keys=[], props_fields=[])
+            self.assertDictEqual(instrument_from_db['series'], {})
+            self.assertDictEqual(instrument_from_db['properties'], {})
+
+    def test_get_latest(self):
+        """Test retrieving the last observations of series"""
+        instruments = xauldron.FinstrumentFaker.get(self.instruments_no)
+        self.assertTrue(self.db.upsert(instruments))
+        now0 = signaldb.get_utc_now()
+        instruments0 = copy.deepcopy(instruments)
+
+        series = instruments[0]['series']['price']
+        series[-1] = [series[-1][0], 999.9]
+        self.assertTrue(self.db.upsert(instruments))
+
+        ticker_list = [tuple(instrument['tickers'][0]) for instrument in instruments]
+        ticker_list.append(('my_source', 'null_ticker'))
+        for n in [1, 3]:
+            latest = self.db.get_latest(ticker_list, ['price'], n=n)
+            self.assertEqual(len(latest), len(ticker_list))
+            self.assertIsNone(latest[-1])
+            for instrument, instrument_from_db in zip(instruments, latest):
+                self.assertListEqual(instrument_from_db['series']['price'], instrument['series']['price'][-n:])
+        latest = self.db.get_latest(ticker_list[:1], ['price'], now=now0)
+        self.assertListEqual(latest[0]['series']['price'], instruments0[0]['series']['price'][-1:])
+        self.assertIsNone(self.db.get_latest(ticker_list, n=0))
+
+    def test_export_import(self):
+        """Export the db into a snapshot, load it into another db and compare the instruments"""
+        self.db.purge_db()
+        instruments = xauldron.FinstrumentFaker.get(self.instruments_no)
+        self.assertTrue(self.db.upsert(instruments))
+        for instrument in instruments:
+            instrument['series']['price'][-1][1] = 999.9
+        instruments[0]['series']['mixed'] = [[datetime.datetime(2019, 1, 2), 1.5],
+                                             [datetime.datetime(2019, 1, 3), 'NA'],
+                                             [datetime.datetime(2019, 1, 4), True],
+                                             [datetime.datetime(2019, 1, 5), 2 ** 62 + 1]]
+        instruments[0]['series']['dates'] = [[datetime.datetime(2019, 1, 2), datetime.datetime(2019, 3, 4, 5, 6, 7)],
+                                             [datetime.datetime(2019, 1, 3), datetime.datetime(2020, 1, 1)]]
+        self.assertTrue(self.db.upsert(instruments))
+
+        target_db = signaldb.SignalDb(self.conn.client['market_test_import'])
+        target_db.purge_db()
+        with tempfile.TemporaryDirectory() as path:
+            self.assertTrue(signaldb.dump.export_db(self.db, path, chunk_size=7))
+            self.assertFalse(signaldb.dump.export_db(self.db, path))
+            self.assertTrue(signaldb.dump.import_db(target_db, path, chunk_size=5))
+            self.assertFalse(signaldb.dump.import_db(target_db, path))
+        self.assertEqual(self.db.count_items(), target_db.count_items())
+        for source, ticker in self.db.list_tickers():
+            self.assertEqual(self.db.get(source, ticker), target_db.get(source, ticker))
+        mixed = target_db.get(*instruments[0]['tickers'][0])['series']['mixed']
+        self.assertListEqual([type(sample[1]) for sample in mixed], [float, str, bool, int])
+        dates = target_db.get(*instruments[0]['tickers'][0])['series']['dates']
+        self.assertListEqual(dates, instruments[0]['series']['dates'])
+        target_db.purge_db()
+
+    def test_local_snapshot(self):
+        """Materialize a local snapshot and compare it with the db"""
+        self.db.purge_db()
+        instruments = xauldron.FinstrumentFaker.get(self.instruments_no)
+        times = [sample[0] for sample in instruments[0]['series']['price']]
+        instruments[0]['series']['volume'] = [[t, 2 ** 60 + i] for i, t in enumerate(times)]
+        instruments[0]['series']['flag'] = [[t, i % 2 == 0] for i, t in enumerate(times)]
+        instruments[0]['series']['label'] = [[t, '1.5'] for t in times]
+        self.assertTrue(self.db.upsert(instruments))
+        now = signaldb.get_utc_now()
+        with tempfile.TemporaryDirectory() as path:
+            snapshot = signaldb.local.materialize(self.db, path + '/snapshot', now=now)
+            self.assertIsNotNone(snapshot)
+            self.assertSetEqual(set(snapshot.list_tickers()), set(self.db.list_tickers(now=now)))
+            for source, ticker in snapshot.list_tickers():
+                instrument_from_db = self.db.get(source, ticker, now)
+                instrument_from_db['series'].pop('label', None)
+                self.assertEqual(snapshot.get(source, ticker), instrument_from_db)
+            source, ticker = instruments[0]['tickers'][0]
+            series = snapshot.get(source, ticker)['series']
+            self.assertNotIn('label', series)
+            self.assertListEqual([type(sample[1]) for sample in series['volume']], [int] * len(times))
+            self.assertListEqual([type(sample[1]) for sample in series['flag']], [bool] * len(times))
+            self.assertIsNone(snapshot.get('my_source', 'null_ticker'))
+            source, ticker = instruments[0]['tickers'][0]
+            times, values = snapshot.get_arrays(source, ticker, 'price')
+            self.assertListEqual(values.tolist(), [sample[1] for sample in instruments[0]['series']['price']])
+
+    def test_get_panel(self):
+        """Test the aligned time x instrument matrix of a series"""
+        instruments = xauldron.FinstrumentFaker.get(self.instruments_no)
+        instruments[0]['series']['price'] = instruments[0]['series']['price'][1:]
+        self.assertTrue(self.db.upsert(instruments))
+
+        ticker_list = [tuple(instrument['tickers'][0]) for instrument in instruments]
+        ticker_list.append(('my_source', 'null_ticker'))
+        times, values = self.db.get_panel(ticker_list, 'price', chunk_size=2)
+        all_times = set(sample[0] for instrument in instruments for sample in instrument['series']['price'])
+        self.assertListEqual(times.astype(datetime.datetime).tolist(), sorted(all_times))
+        self.assertEqual(values.shape, (len(times), len(ticker_list)))
+        self.assertTrue(all(math.isnan(v) for v in values[:, -1]))
+        for j, instrument in enumerate(instruments):
+            series = dict(instrument['series']['price'])
+            for i, t in enumerate(times.astype(datetime.datetime).tolist()):
+                if t in series:
+                    self.assertEqual(values[i, j], series[t])
+                else:
+                    self.assertTrue(math.isnan(values[i, j]))
+
+        times = [sample[0] for sample in instruments[0]['series']['price']]
+        for value in [True, '1.5', None]:
+            instruments[0]['series']['other'] = [[times[0], 1.0], [times[1], value]]
+            self.assertTrue(self.db.upsert(instruments))
+            self.assertIsNone(self.db.get_panel(ticker_list[:1], 'other'))
+
+    def test_buffered_writer(self):
+        """Append samples through the write-behind writer and compare with the db"""
+        instruments = xauldron.FinstrumentFaker.get(self.instruments_no)
+        self.assertTrue(self.db.upsert(instruments))
+        new_series = xauldron.FinstrumentFaker.get_series()
+        with signaldb.writer.BufferedWriter(self.db, flush_interval=0.01, max_batch_size=5, max_pending=10) as writer:
+            for instrument in instruments:
+                source, ticker = instrument['tickers'][0]
+                for sample in new_series:
+                    writer.append(source, ticker, 'new_series', [sample, ])
+                instrument['series']['new_series'] = new_series
+        metrics = writer.get_metrics()
+        self.assertEqual(metrics['samples'], len(instruments) * len(new_series))
+        self.assertEqual(metrics['errors'], 0)
+        self.assertLessEqual(metrics['max_batch_size'], 10)
+        self.assertRaises(ValueError, writer.append, 'my_source', 'my_ticker', 'price', [])
+        self.compare_instruments_with_db(instruments)
+
+    def test_buffered_writer_failure(self):
+        """Samples of failed writes are kept and written by a later flush"""
+        instruments = xauldron.FinstrumentFaker.get(1)
+        self.assertTrue(self.db.upsert(instruments))
+        failing_db = FailingDb(self.db)
+        writer = signaldb.writer.BufferedWriter(failing_db, flush_interval=60.0)
+        source, ticker = instruments[0]['tickers'][0]
+        new_series = xauldron.FinstrumentFaker.get_series()
+        writer.append(source, ticker, 'new_series', new_series)
+        self.assertRaises(IOError, writer.flush)
+        self.assertEqual(writer.get_metrics()['pending'], len(new_series))
+        failing_db.fail = False
+        writer.close()
+        instruments[0]['series']['new_series'] = new_series
+        self.compare_instruments_with_db(instruments)
+
+    def test_buffered_writer_close_blocked_append(self):
+        """An append blocked by back-pressure fails when the writer is closed"""
+        instruments = xauldron.FinstrumentFaker.get(1)
+        source, ticker = instruments[0]['tickers'][0]
+        new_series = xauldron.FinstrumentFaker.get_series()
+        writer = signaldb.writer.BufferedWriter(FailingDb(self.db), flush_interval=60.0, max_batch_size=1,
+                                                max_pending=1)
+        writer.append(source, ticker, 'new_series', new_series[:1])
+        errors = []
+
+        def append():
+            try:
+                writer.append(source, ticker, 'new_series', new_series[1:2])
+            except ValueError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=append)
+        thread.start()
+        time.sleep(0.1)
+        self.assertRaises(IOError, writer.close)
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(writer.get_metrics()['pending'], 1)
+
+    def test_upsert_tickers_of_one_instrument(self):
+        """Upsert two tickers of the same instrument in one batch"""
+        instrument = xauldron.FinstrumentFaker.get(1)[0]
+        instrument['tickers'] = [['test_source', 'a%f' % time.time()], ['test_source', 'b%f' % time.time()]]
+        self.assertTrue(self.db.upsert([instrument, ]))
+        now0 = signaldb.get_utc_now()
+        instrument0 = self.db.get(*instrument['tickers'][0])
+        times = [sample[0] for sample in instrument['series']['price']]
+        first = {'tickers': instrument['tickers'][:1], 'properties': {},
+                 'series': {'price': [[times[0], 1.0], [times[1], 2.0]]}}
+        second = {'tickers': instrument['tickers'][1:], 'properties': {},
+                  'series': {'price': [[times[1], 3.0], [times[2], 4.0]]}}
+        self.assertTrue(self.db.upsert([first, second], consolidate_flag=False))
+        price = dict((t, v) for t, v in instrument0['series']['price'])
+        price.update({times[0]: 1.0, times[1]: 3.0, times[2]: 4.0})
+        self.assertListEqual(self.db.get(*instrument['tickers'][1])['series']['price'],
+                             [[t, price[t]] for t in sorted(price)])
+        self.assertEqual(self.db.get(*instrument['tickers'][0], now=now0), instrument0)
+
+    def test_partitioned_db(self):
+        """Test a db with observations partitioned by year"""
+        self.assertTrue(self.db.upsert(xauldron.FinstrumentFaker.get(1)))
+        self.assertRaises(ValueError, signaldb.SignalDb, self.conn, 'year')
+        self.assertRaises(ValueError, signaldb.SignalDb, self.conn, 'unsupported')
+
+        partitioned_db = signaldb.SignalDb(self.conn.client['market_test_partitioned'], partition_by='year')
+        partitioned_db.purge_db()
+        self.assertEqual(signaldb.SignalDb(partitioned_db.db).partition_by, 'year')
+        instruments = xauldron.FinstrumentFaker.get(self.instruments_no)
+        self.assertTrue(partitioned_db.upsert(instruments))
+        now0 = signaldb.get_utc_now()
+        instruments0 = copy.deepcopy(instruments)
+        for instrument in instruments:
+            instrument['series']['price'][0][1] = 999.9
+        self.assertTrue(partitioned_db.upsert(instruments))
+
+        years = set(sample[0].year for i in instruments for series in i['series'].values() for sample in series)
+        self.assertListEqual(partitioned_db.sheets_cols(), ['sheets_%04d' % year for year in sorted(years)])
+        # A partition created by another connection is visible at once
+        other_db = signaldb.SignalDb(partitioned_db.db)
+        source, ticker = instruments[0]['tickers'][0]
+        self.assertTrue(other_db.upsert([{'tickers': [[source, ticker], ], 'properties': {},
+                                          'series': {'price': [[datetime.datetime(max(years) + 1, 1, 1), 1.0]]}}],
+                                        consolidate_flag=False))
+        self.assertIn('sheets_%04d' % (max(years) + 1), partitioned_db.sheets_cols())
+        self.assertListEqual(partitioned_db.get_latest([(source, ticker)], ['price'])[0]['series']['price'],
+                             [[datetime.datetime(max(years) + 1, 1, 1), 1.0]])
+        instruments[0]['series']['price'].append([datetime.datetime(max(years) + 1, 1, 1), 1.0])
+        years.add(max(years) + 1)
+        for instruments_snapshot, now in [(instruments, None), (instruments0, now0)]:
+            for instrument in instruments_snapshot:
+                source, ticker = instrument['tickers'][0]
+                instrument_from_db = partitioned_db.get(source, ticker, now)
+                self.assertDictEqual(instrument_from_db['series'], instrument['series'])
+                latest = partitioned_db.get_latest([(source, ticker)], ['price'], now=now, n=2)
+                self.assertListEqual(latest[0]['series']['price'], instrument['series']['price'][-2:])
+        # The partitions are listed once per call, not once per series
+        list_collection_names = partitioned_db.db.list_collection_names
+        calls = []
+        partitioned_db.db.list_collection_names = lambda *args, **kwargs: \
+            calls.append(1) or list_collection_names(*args, **kwargs)
+        self.assertEqual(len(partitioned_db.get_many([i['tickers'][0] for i in instruments])), len(instruments))
+        self.assertEqual(len(calls), 1)
+        del partitioned_db.db.list_collection_names
+
+        partitioned_db.rollback(xauldron.rfc3339.datetime_to_str(now0))
+        for instrument in instruments0:
+            source, ticker = instrument['tickers'][0]
+            self.assertDictEqual(partitioned_db.get(source, ticker)['series'], instrument['series'])
+
+        min_year = min(years)
+        self.assertTrue(partitioned_db.drop_partition('sheets_%04d' % min_year))
+        self.assertFalse(partitioned_db.drop_partition('sheets'))
+        self.assertNotIn('sheets_%04d' % min_year, partitioned_db.sheets_cols())
+        partitioned_db.purge_db()
+
+    def test_query_service(self):
+        """Test the cached query service"""
+        instruments = xauldron.FinstrumentFaker.get(self.instruments_no)
+        self.assertTrue(self.db.upsert(instruments))
+        service = signaldb.service.QueryService(self.db, revision_poll=0.0)
+        source, ticker = instruments[0]['tickers'][0]
+        params = {'source': source, 'ticker': ticker, 'series_keys': ['price']}
+        lines = list(service.query('get', params))
+        self.assertListEqual(lines, [signaldb.service.encode_line(self.db.get(source, ticker, series_keys=['price']))])
+        self.assertListEqual(list(service.query('get', params)), lines)
+        self.assertEqual(service.metrics['cache_hits'], 1)
+        self.assertEqual(service.cached_bytes, len(lines[0]))
+
+        ticker_list = [instrument['tickers'][0] for instrument in instruments]
+        lines = list(service.query('get_latest', {'tickers': ticker_list, 'series_keys': ['price'], 'n': 2}))
+        self.assertEqual(len(lines), len(ticker_list))
+        self.assertRaises(ValueError, service.query, 'get', {'source': source})
+        self.assertRaises(ValueError, service.query, 'purge_db', {})
+
+        instruments[0]['series']['price'][-1][1] = 999.9
+        self.assertTrue(self.db.upsert(instruments))
+        lines = list(service.query('get', params))
+        self.assertEqual(service.metrics['cache_hits'], 1)
+        self.assertListEqual(lines, [signaldb.service.encode_line(self.db.get(source, ticker, series_keys=['price']))])
+
+        # Responses above max_cached_response are streamed but not cached; the cache is bounded by cache_bytes
+        service = signaldb.service.QueryService(self.db, cache_bytes=len(lines[0]), max_cached_response=len(lines[0]),
+                                                revision_poll=0.0)
+        self.assertListEqual(list(service.query('get_many', {'tickers': ticker_list})),
+                             [signaldb.service.encode_line(instrument) for instrument in self.db.get_many(ticker_list)])
+        self.assertEqual(len(service.cache), 0)
+        list(service.query('get', params))
+        list(service.query('get', dict(params, series_keys=['price', 'volume'])))
+        self.assertLessEqual(service.cached_bytes, len(lines[0]))
+        self.assertEqual(len(service.cache), 1)
+
+    def test_batch(self):
+        """Test answering a stream of json line queries"""
+        instruments = xauldron.FinstrumentFaker.get(self.instruments_no)
+        self.assertTrue(self.db.upsert(instruments))
+        source, ticker = instruments[0]['tickers'][0]
+        queries = [{'query': 'get', 'params': {'source': source, 'ticker': ticker}, 'id': 1},
+                   {'query': 'purge_db', 'id': 2},
+                   {'query': 'get_many', 'params': {'tickers': [1]}, 'id': 3},
+                   {'query': 'find_instruments', 'params': {'filter': [1]}, 'id': 4},
+                   {'query': 'list_tickers', 'params': {'source': source}, 'id': 5}]
+        output_fp = io.StringIO()
+        input_fp = io.StringIO('\n'.join(json.dumps(query) for query in queries) + '\n')
+        self.assertEqual(signaldb.service.run_batch(self.db, input_fp, output_fp), 3)
+        responses = [json.loads(line) for line in output_fp.getvalue().splitlines()]
+        self.assertListEqual([response['id'] for response in responses], [1, 2, 3, 4, 5])
+        self.assertEqual(len(responses[0]['results']), 1)
+        for response in responses[1:4]:
+            self.assertIn('error', response)
+        self.assertIn([source, ticker], responses[4]['results'])
+
+    def test_indexes_record(self):
+        """Test that index creation is recorded and skipped for existing indexes"""
+        self.assertTrue(self.db.indexes_exist())
+        self.db.drop_indexes()
+        self.assertFalse(self.db.indexes_exist())
+        self.assertTrue(signaldb.SignalDb(self.conn).indexes_exist())
+        self.assertIn('k_t_r_index', self.db.db[self.db.sheets_col].index_information())
+
+    def test_query_handler(self):
+        """Query the HTTP service with GET parameters"""
+        instrument = xauldron.FinstrumentFaker.get(1)[0]
+        instrument['tickers'] = [['TSE', '7203'], ]
+        self.assertTrue(self.db.upsert([instrument, ]))
+        handler = type('Handler', (signaldb.service.QueryRequestHandler, ),
+                       {'service': signaldb.service.QueryService(self.db)})
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            query = urllib.parse.urlencode({'source': 'TSE', 'ticker': '7203', 'series_keys': '["price"]'})
+            url = 'http://127.0.0.1:%d/get?%s' % (server.server_address[1], query)
+            with urllib.request.urlopen(url) as response:
+                instrument_from_service = json.loads(response.read().decode('utf-8'))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertListEqual(instrument_from_service['tickers'], [['TSE', '7203'], ])
+        self.assertListEqual(list(instrument_from_service['series'].keys()), ['price'])
+
+    def test_stats(self):
+        """Test the db statistics"""
+        self.db.purge_db()
+        instruments = xauldron.FinstrumentFaker.get(self.instruments_no)
+        self.assertTrue(self.db.upsert(instruments))
+
+        collections = {col['name']: col for col in signaldb.stats.collection_stats(self.db)}
+        self.assertIn('k_t_r_index', collections['sheets']['indexes'])
+        source_counts = signaldb.stats.source_stats(self.db)
+        tickers = [ticker for instrument in instruments for ticker in instrument['tickers']]
+        self.assertEqual(sum(counts['tickers'] for counts in source_counts.values()), len(tickers))
+        self.assertEqual(len(signaldb.stats.revision_stats(self.db, top=2)), 2)
+
+        series = signaldb.stats.series_stats(self.db, top=1)
+        longest = max(len(s) for instrument in instruments for s in instrument['series'].values())
+        self.assertEqual(series[0]['observations'], longest)
+        self.assertEqual(series[0]['revisions'], 1)
+        self.assertGreater(len(series[0]['tickers']), 0)
+        self.assertEqual(len(signaldb.stats.series_stats(self.db, top=1, sample_size=10)), 1)
+
     # def test_get_series_slice(self):
     #     """Test the parameters series_from and series_to of the get function"""
     #     instruments = signaldb.FinstrumentFaker.get(self.instruments_no)
@@ -0,0 +1,58 @@
+import copy
+import json
+import unittest
+import signaldb
+import signaldb.consolidation
+import xauldron
+
+
+class ConsolidationTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        instruments = xauldron.FinstrumentFaker.get(6)
+        # Instruments sharing tickers directly and transitively
+        extra = copy.deepcopy(instruments[:3])
+        extra[0]['tickers'] = extra[0]['tickers'][:1] + [['extra_source', 'extra_0']]
+        extra[0]['properties']['extra_property'] = 1234567
+        extra[1]['tickers'] = [['extra_source', 'extra_0'], ['extra_source', 'extra_1']]
+        extra[2]['tickers'] = [['extra_source', 'extra_1']] + extra[2]['tickers'][-1:]
+        for instrument in extra:
+            instrument['series']['new_series'] = xauldron.FinstrumentFaker.get_series()
+        # Time stamps as strings, as read from json input files
+        self.instruments = json.loads(json.dumps(instruments + extra, cls=signaldb.JSONEncoderExtension))
+
+    def test_consolidate_matches_reference(self):
+        for props_merge_mode in ['append', 'replace']:
+            for processes in [None, 2]:
+                with self.subTest(props_merge_mode=props_merge_mode, processes=processes):
+                    reference = self.consolidate_reference(copy.deepcopy(self.instruments), props_merge_mode)
+                    consolidated = signaldb.consolidation.consolidate(copy.deepcopy(self.instruments),
+                                                                      props_merge_mode, processes)
+                    self.assertListEqual(self.canonical_form(consolidated), self.canonical_form(reference))
+
+    def test_group_by_tickers(self):
+        groups = signaldb.consolidation.group_by_tickers(self.instruments)
+        self.assertEqual(len(groups), 5)
+        self.assertEqual(sum(len(group) for group in groups), len(self.instruments))
+
+    def test_parse_times(self):
+        times = ['2019-01-02T03:04:05Z', '2019-01-02T03:04:05.123Z', '2019-01-02T03:04:05.123456Z']
+        self.assertListEqual(signaldb.consolidation.parse_times(list(times)),
+                             [xauldron.rfc3339.str_to_datetime(t) for t in times])
+        for times in [['2019-01-02T03:04:05+01:00', 'not a time stamp'],
+                      ['2019-01-02T03:04:05Z', '2019-02-30T00:00:00Z'],
+                      ['2016-12-31T23:59:60Z']]:
+            reference = list(times)
+            xauldron.rfc3339.recursive_str_to_datetime(reference)
+            self.assertListEqual(signaldb.consolidation.parse_times(list(times)), reference)
+
+    @staticmethod
+    def consolidate_reference(instruments, props_merge_mode):
+        """The consolidation as done by SignalDb.consolidate before the fast path"""
+        xauldron.rfc3339.recursive_str_to_datetime(instruments)
+        checked_instruments = [i for i in instruments if xauldron.finstruments.check(i) == 0]
+        return xauldron.finstruments.consolidate(checked_instruments, props_merge_mode)
+
+    @staticmethod
+    def canonical_form(instruments):
+        return sorted((json.dumps(i, sort_keys=True, cls=signaldb.JSONEncoderExtension) for i in instruments))
@@ -0,0 +1,63 @@
+import datetime
+import io
+import unittest
+import bson
+import signaldb.formats
+import xauldron
+
+
+class FormatsTest(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.instruments = xauldron.FinstrumentFaker.get(3)
+        for instrument in self.instruments:
+            signaldb.recursive_truncate_microseconds(instrument['series'])
+        self.instruments[0]['series']['labels'] = [[datetime.datetime(2019, 1, 2, 3, 4, 5, 6000), 'a'],
+                                                   [datetime.datetime(2019, 1, 3, 3, 4, 5, 6000), 'b']]
+        self.instruments[0]['series']['records'] = [[datetime.datetime(2019, 1, 2), {'a': 1}]]
+        self.instruments[0]['series']['mixed'] = [[datetime.datetime(2019, 1, 2), 1.5],
+                                                  [datetime.datetime(2019, 1, 3), 'NA'],
+                                                  [datetime.datetime(2019, 1, 4), True]]
+        self.instruments.append(None)
+
+    def test_epoch_ms(self):
+        times = [datetime.datetime(1970, 1, 1), datetime.datetime(2019, 5, 6, 7, 8, 9, 123000)]
+        epoch_ms = signaldb.formats.datetimes_to_epoch_ms(times)
+        self.assertListEqual(epoch_ms.tolist(), [0, 1557126489123])
+        self.assertListEqual(signaldb.formats.epoch_ms_to_datetimes(epoch_ms), times)
+
+    def test_mixed_values(self):
+        for values in [[1.5, 'NA'], [True, 1.0], [1, 2.5], [2 ** 63, 1], [1, None], [datetime.datetime(2019, 1, 2)],
+                       [bson.ObjectId(), {'a': [1, 'b']}]]:
+            array, encoding = signaldb.formats.values_to_array(values)
+            self.assertNotEqual(encoding, 'native')
+            restored = signaldb.formats.array_to_values(array, encoding)
+            self.assertListEqual(restored, values)
+            self.assertListEqual([type(v) for v in restored], [type(v) for v in values])
+        for values in [[1.5, 2.5], [1, 2], [True, False], ['a', 'b'], []]:
+            array, encoding = signaldb.formats.values_to_array(values)
+            self.assertEqual(encoding, 'native')
+            self.assertListEqual(signaldb.formats.array_to_values(array, encoding), values)
+
+    def test_npz_round_trip(self):
+        fp = io.BytesIO()
+        signaldb.formats.write_npz(self.instruments, fp)
+        fp.seek(0)
+        self.compare_instruments(self.instruments, signaldb.formats.read_npz(fp))
+
+    def test_jsonl_round_trip(self):
+        fp = io.StringIO()
+        signaldb.formats.write_jsonl(self.instruments, fp)
+        self.assertEqual(len(fp.getvalue().splitlines()), len(self.instruments))
+        fp.seek(0)
+        self.compare_instruments(self.instruments, signaldb.formats.read_jsonl(fp))
+
+    def compare_instruments(self, instruments, instruments_from_file):
+        """Compare tickers and series; datetime properties are read back as strings"""
+        self.assertEqual(len(instruments_from_file), len(instruments))
+        for instrument, instrument_from_file in zip(instruments, instruments_from_file):
+            if instrument is None:
+                self.assertIsNone(instrument_from_file)
+                continue
+            self.assertListEqual(instrument_from_file['tickers'], instrument['tickers'])
+            self.assertDictEqual(instrument_from_file['series'], instrument['series'])